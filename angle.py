@@ -4,6 +4,7 @@
 
 import numpy as np
 import cv2 as cv
+from disparity import get_engine
 
 
 class Angle():
@@ -101,12 +102,12 @@ class Angle():
                         self.images.input['right'][0]]
         image0 = input_images[0].preprocess(perform_rotation=False)
         image1 = input_images[1].preprocess(perform_rotation=False)
-        flow = cv.FarnebackOpticalFlow_create()
-        results = flow.calc(image0, image1, None)
+        results = get_engine('flow').flow(image0, image1)
         results = self.images.filter_plants(results)
         self.deltas = {'x': results[:, :, 0], 'y': results[:, :, 1]}
         self._compare_angles()
         disparity_data_floats = np.hypot(self.deltas['x'], self.deltas['y'])
         disparity_data = np.int32(disparity_data_floats * 16)
-        self.log.debug(f'{disparity_data.min() = } {disparity_data.max() = }')
+        self.log.debug(
+            lambda: f'{disparity_data.min() = } {disparity_data.max() = }')
         self.images.output_init(disparity_data, 'disparity_from_flow')
@@ -2,17 +2,33 @@
 
 'Calculations.'
 
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue
 import numpy as np
-import cv2 as cv
 from process_image import shape, odd, rotate
 from images import Images
 from angle import Angle
+from disparity import ENGINES, FUSIONS, get_engine, set_thread_policy
+
+
+def bounded_map(pool, function, items, window):
+    'Like pool.map, but with at most `window` items submitted ahead of the results.'
+    futures = deque()
+    for item in items:
+        if len(futures) >= window:
+            yield futures.popleft().result()
+        futures.append(pool.submit(function, item))
+    while futures:
+        yield futures.popleft().result()
 
 
 class Calculate():
     'Calculate results.'
 
-    def __init__(self, core, input_images):
+    def __init__(self, core, input_images, history=None):
         self.settings = core.settings.settings
         self.imgs = core.settings.images
         self.log = core.log
@@ -20,6 +36,7 @@ class Calculate():
         self.images = Images(core, input_images, self.calculate_soil_z)
         self.z_info = self.images._get_z_info()
         self.calculated_angle = 0
+        self.history = history if history is not None else []
 
     def check_images(self):
         'Check capture images.'
@@ -105,25 +122,139 @@ class Calculate():
         if block_size != block_size_setting:
             self.settings['disparity_block_size'] = block_size
             self.results.save_config('disparity_block_size')
-        stereo = cv.StereoBM().create(num_disparities, block_size)
-        disparities = []
-        for j, left_image in enumerate(self.images.input['left']):
-            for k, right_image in enumerate(self.images.input['right']):
-                left = left_image.preprocess()
-                right = right_image.preprocess()
-                result = stereo.compute(left, right)
-                multiple = len(self.images.input['left']) > 1
-                if multiple and self.imgs['multi_depth']:
-                    tag = f'disparity_{j}_{k}'
-                    self.images.output_init(result, tag, reduce=False)
-                    self.images.output[tag].normalize()
-                    self.images.output[tag].save(f'depth_map_bw_{j}_{k}')
-                disparities.append(result)
-        disparity_data = disparities[0]
-        for computed in disparities[1:]:
-            mask = disparity_data < self.settings['pixel_value_threshold']
-            disparity_data[mask] = computed[mask]
-        self.images.output_init(disparity_data, 'disparity_from_stereo')
+        engine_name = self.settings['disparity_engine']
+        if engine_name not in ENGINES:
+            self.log.error(f"Unknown disparity engine '{engine_name}'.")
+        fusion_name = self.settings['disparity_fusion']
+        if fusion_name not in FUSIONS:
+            self.log.error(f"Unknown disparity fusion '{fusion_name}'.")
+        search_range = self._search_range(num_disparities)
+        fusion = self._stereo_fusion(engine_name, block_size, *search_range)
+        if self._at_range_edge(fusion.result(), *search_range, num_disparities):
+            self.log.debug('Disparity at search range edge. Searching full range...',
+                           verbosity=2)
+            fusion = self._stereo_fusion(engine_name, block_size, 0, num_disparities)
+        self._record_band(fusion.result())
+        self.images.output_init(fusion.result(), 'disparity_from_stereo')
+        confidence = fusion.confidence()
+        self.images.output_init(confidence, 'disparity_confidence', reduce=False)
+        if fusion.total > 1 and self.imgs['multi_depth']:
+            self.images.output['disparity_confidence'].save('disparity_confidence')
+
+    def _stereo_fusion(self, engine_name, block_size, min_disparity, num_disparities):
+        engine = partial(get_engine, engine_name, num_disparities, block_size,
+                         min_disparity=min_disparity)
+        fusion = FUSIONS[self.settings['disparity_fusion']](
+            self.settings['pixel_value_threshold'])
+        multiple = len(self.images.input['left']) > 1
+        if multiple and self.settings['fuse_captures']:
+            fused = self._fuse_captures()
+            set_thread_policy(1, self.settings['opencv_threads'])
+            fusion.add(self._compute(engine(), fused['left'], fused['right']))
+        else:
+            for disparity in self._pair_disparities(engine):
+                fusion.add(disparity)
+        return fusion
+
+    def _expected_disparity(self):
+        offset = self.settings['calibration_disparity_offset']
+        factor = self.settings['calibration_factor']
+        if not self.settings['auto_search_range'] or offset == 0 or factor == 0:
+            return None
+        return offset + self.z_info['offset'] / factor
+
+    def _search_range(self, num_disparities):
+        'Return (min_disparity, num_disparities) covering the expected disparities.'
+        expected = self._expected_disparity()
+        if expected is None:
+            return 0, num_disparities
+        spread = abs(self.settings['calibration_maximum']
+                     - self.settings['calibration_disparity_offset'])
+        bands = self.history or [(-spread, spread)]
+        margin = self.settings['search_range_margin']
+        low = max(0, int((expected + min(band[0] for band in bands)) / 16 - margin))
+        high = (expected + max(band[1] for band in bands)) / 16 + margin
+        count = max(16, int(np.ceil((high - low) / 16)) * 16)
+        if count >= num_disparities:
+            return 0, num_disparities
+        self.log.debug(f'Searching disparities {low} to {low + count} px...',
+                       verbosity=3)
+        return low, count
+
+    def _at_range_edge(self, disparity, min_disparity, count, num_disparities):
+        if (min_disparity, count) == (0, num_disparities):
+            return False
+        valid = disparity[disparity >= self.settings['pixel_value_threshold']]
+        if valid.size == 0:
+            return True
+        at_edge = 0
+        if min_disparity > 0:
+            at_edge += np.count_nonzero(valid < 16 * (min_disparity + 1))
+        if min_disparity + count < num_disparities:
+            at_edge += np.count_nonzero(valid >= 16 * (min_disparity + count - 1))
+        percent = 100 * at_edge / valid.size
+        return percent > self.settings['search_range_edge_percent']
+
+    def _record_band(self, disparity):
+        expected = self._expected_disparity()
+        valid = disparity[disparity >= self.settings['pixel_value_threshold']]
+        if expected is None or valid.size == 0:
+            return
+        low, high = np.percentile(valid, [1, 99])
+        self.history.append((low - expected, high - expected))
+
+    def _compute(self, engine, left, right):
+        disparity, info = engine.compute(left, right)
+        msg = f"{info['engine']} disparity: {info['coverage']}% coverage"
+        self.log.debug(f"{msg} in {info['duration']}s", verbosity=3)
+        return disparity
+
+    def _pair_disparities(self, engine):
+        lefts = [image.preprocess() for image in self.images.input['left']]
+        rights = [image.preprocess() for image in self.images.input['right']]
+        pairs = [(j, k) for j in range(len(lefts)) for k in range(len(rights))]
+        workers = self.settings['disparity_workers'] or os.cpu_count() or 1
+        workers = max(1, min(workers, len(pairs)))
+        set_thread_policy(workers, self.settings['opencv_threads'])
+        engines = Queue()
+        for instance in range(workers):
+            engines.put(engine(instance))
+
+        def _compute_pair(pair):
+            pair_engine = engines.get()
+            try:
+                return self._compute(pair_engine, lefts[pair[0]], rights[pair[1]])
+            finally:
+                engines.put(pair_engine)
+
+        if workers > 1:
+            self.log.debug(f'Matching {len(pairs)} pairs with {workers} workers...',
+                           verbosity=3)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                yield from self._save_pair_disparities(
+                    pairs, bounded_map(pool, _compute_pair, pairs, workers))
+        else:
+            yield from self._save_pair_disparities(
+                pairs, map(_compute_pair, pairs))
+
+    def _save_pair_disparities(self, pairs, disparities):
+        multiple = len(self.images.input['left']) > 1
+        for (j, k), result in zip(pairs, disparities):
+            if multiple and self.imgs['multi_depth']:
+                tag = f'disparity_{j}_{k}'
+                self.images.output_init(result, tag, reduce=False)
+                self.images.output[tag].normalize()
+                self.images.output[tag].save(f'depth_map_bw_{j}_{k}')
+            yield result
+
+    def _fuse_captures(self):
+        'Combine the captures at each location into a single denoised frame.'
+        fused = {}
+        for stereo_id, images in self.images.input.items():
+            self.log.debug(f'Fusing {len(images)} {stereo_id} captures...')
+            frames = np.stack([image.preprocess() for image in images])
+            fused[stereo_id] = np.median(frames, axis=0).astype(np.uint8)
+        return fused
 
     def _from_flow(self):
         self.log.debug('Calculating flow...')
@@ -180,8 +311,13 @@ class Calculate():
         self.disparity_debug_logs()
 
         missing_disparity_offset = self.settings['calibration_disparity_offset'] == 0
+        analytical = self.images.core.settings.analytical_calibration()
         if missing_disparity_offset:
             self.set_disparity_offset()
+            if missing_calibration_factor and analytical:
+                self.set_analytical_calibration_factor()
+                self.results.save_calibration()
+                missing_disparity_offset = False
         elif missing_calibration_factor:
             self.set_calibration_factor()
             self.results.save_calibration()
@@ -269,3 +405,14 @@ class Calculate():
             self.log.error('Zero offset.')
         factor = round(self.z_info['offset'] / disparity_difference, 4)
         self.settings['calibration_factor'] = factor
+
+    def set_analytical_calibration_factor(self):
+        'Set calibration_factor from the pinhole camera model.'
+        self.log.debug('Calculating analytical calibration factor...', verbosity=2)
+        distance = self.settings['measured_distance']
+        mm_per_pixel = self.settings['millimeters_per_pixel']
+        baseline = self.settings['stereo_y']
+        # Slope of distance vs. disparity (1/16 px) at the measured distance for
+        # disparity = focal_length * baseline / z, focal_length = distance / mm_per_pixel
+        factor = round(distance * mm_per_pixel / (16 * baseline), 4)
+        self.settings['calibration_factor'] = factor
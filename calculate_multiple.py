@@ -2,6 +2,7 @@
 
 'Perform calculations on multiple stereo image sets.'
 
+import os
 import json
 from time import time
 import numpy as np
@@ -9,6 +10,8 @@ import cv2 as cv
 from calculate import Calculate
 from plot import Plot
 
+HISTORY_LENGTH = 20  # disparity bands kept from past runs
+
 
 def _abridged(histogram):
     low_label_mask = ['low' in h for h in histogram]
@@ -52,6 +55,7 @@ class CalculateMultiple():
         self.title = core.settings.title
         self.image_sets = image_sets
         self.set_results = None
+        self.disparity_history = self.load_history()
         if image_sets is not None:
             self._after_load()
 
@@ -67,9 +71,36 @@ class CalculateMultiple():
             self.settings['disparity_search_depth'] = recommended_search_depth
             self.results.save_config('disparity_search_depth')
 
+    def load_history(self):
+        'Load disparity bands recorded in past runs.'
+        path = self.settings['search_range_history_file']
+        if not self.settings['auto_search_range'] or not path:
+            return []
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, 'r') as history_file:
+                return [tuple(band) for band in json.load(history_file)]
+        except ValueError:
+            self.log.debug(f'Ignoring corrupt search range history {path}.')
+            return []
+
+    def save_history(self):
+        'Save the most recent disparity bands for future runs.'
+        path = self.settings['search_range_history_file']
+        if not self.settings['auto_search_range'] or not path:
+            return
+        self.disparity_history[:] = self.disparity_history[-HISTORY_LENGTH:]
+        bands = [[float(low), float(high)] for low, high in self.disparity_history]
+        with open(path, 'w') as history_file:
+            json.dump(bands, history_file)
+
     def load_images(self, image_set_data):
         'Load image sets.'
         self.image_sets = []
+        read_flag = cv.IMREAD_COLOR
+        if self.core.settings.luma_only():
+            read_flag = cv.IMREAD_GRAYSCALE
         for i, image_set in enumerate(image_set_data):
             self.image_sets.append({})
             location = image_set.get('location')
@@ -80,7 +111,7 @@ class CalculateMultiple():
                 for image in images:
                     image['tag'] = stereo_id
                     image['location'] = image.get('location', location)
-                    image['data'] = cv.imread(image['name'])
+                    image['data'] = cv.imread(image['name'], read_flag)
                     if image['data'] is None:
                         self.log.error(f"'{image['name']}' doesn't exist.")
                     self.image_sets[i][stereo_id].append(image)
@@ -90,17 +121,43 @@ class CalculateMultiple():
         'Run calculations for each image set.'
         if self.image_sets is None:
             self.log.error('No images provided.')
-        for i, image_set in enumerate(self.image_sets):
-            start = time()
-            calculation = Calculate(self.core, image_set)
-            details = calculation.calculate()
-            if details is not None:
-                disparity = calculation.images.output['disparity'].data.reduced
-                histogram_data = disparity.get('histogram', [])
-                details['histogram'] = _abridged(histogram_data)
-                details['duration'] = round(time() - start, 2)
-                self.set_results[i] = details
-
+        for i in range(len(self.image_sets)):
+            self.calculate_set(i)
+        self.summarize()
+
+    def calculate_set(self, i):
+        'Run calculations for a single image set.'
+        self.set_results += [None] * (i + 1 - len(self.set_results))
+        start = time()
+        calculation = Calculate(self.core, self.image_sets[i], self.disparity_history)
+        details = calculation.calculate()
+        self.save_history()
+        if details is not None:
+            disparity = calculation.images.output['disparity'].data.reduced
+            histogram_data = disparity.get('histogram', [])
+            details['histogram'] = _abridged(histogram_data)
+            details['duration'] = round(time() - start, 2)
+            self.set_results[i] = details
+
+    def fit_converged(self):
+        'Check if the disparity vs distance fit has stopped changing.'
+        set_results = [r for r in self.set_results
+                       if r is not None and r.get('values') is not None
+                       and r['values'].get('calc_distance') is not None]
+        if len(set_results) < 3:
+            return False
+        disparity = [r['values']['disparity'] for r in set_results]
+        expected = [r['values']['new_meas_dist'] for r in set_results]
+        previous = np.array(_best_fit(disparity[:-1], expected[:-1]))
+        current = np.array(_best_fit(disparity, expected))
+        change = np.abs(current - previous) / np.maximum(np.abs(previous), 1e-6)
+        change_percent = np.round(change * 100, 2)
+        self.log.debug(f'calibration fit change (slope, intercept): {change_percent}%')
+        tolerance = self.settings['fit_convergence_tolerance']
+        return bool(all(change_percent < tolerance))
+
+    def summarize(self):
+        'Plot and save results of all calculated sets.'
         if len(self.image_sets) > 1 and self.core.settings.images['plot']:
             self.plot()
 
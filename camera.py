@@ -0,0 +1,225 @@
+#!/usr/bin/env python3.8
+
+'Camera session.'
+
+import threading
+from time import time, sleep
+import numpy as np
+from position import position_at
+
+
+def _thumbnail(image):
+    step = max(1, image.shape[0] // 60)
+    small = image[::step, ::step].astype(float)
+    return small.mean(axis=2) if len(small.shape) > 2 else small
+
+
+def frames_settled(previous, current, tolerance):
+    'Check if successive thumbnails agree within a tolerance (percent).'
+    luminance_change = abs(previous.mean() - current.mean()) / 2.55
+    frame_difference = np.abs(previous - current).mean() / 2.55
+    return max(luminance_change, frame_difference) <= tolerance
+
+
+def capture_quality(image, settings):
+    'Check coverage and sharpness of a downscaled copy of a capture.'
+    gray = _thumbnail(image)
+    coverage = (gray > settings['pixel_value_threshold']).mean() * 100
+    laplacian = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2]
+                 + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1])
+    sharpness = laplacian.var() if laplacian.size > 0 else 0
+    ok = (coverage >= settings['input_coverage_threshold']
+          and sharpness >= settings['capture_sharpness_threshold'])
+    report = f'capture quality: {coverage:.1f}% coverage, '
+    report += f'{sharpness:.1f} sharpness'
+    return {'ok': ok, 'coverage': coverage, 'sharpness': sharpness,
+            'report': report}
+
+
+def discard_until_settled(camera, settings, log, delay=0.1):
+    'Discard frames until the exposure settles. Return the count discarded.'
+    maximum = settings['frame_discard_count']
+    tolerance = settings['frame_settle_tolerance']
+    threshold = settings['pixel_value_threshold']
+    coverage = settings['input_coverage_threshold']
+    start = time()
+    previous = None
+    discarded = 0
+    while discarded < maximum:
+        ret, image = camera.read()
+        sleep(delay)
+        discarded += 1
+        if not ret or image is None:
+            previous = None
+            continue
+        current = _thumbnail(image)
+        if (current > threshold).mean() * 100 < coverage:
+            # Unexposed frames are often identical, but not settled.
+            previous = None
+            continue
+        if previous is not None and frames_settled(previous, current, tolerance):
+            break
+        previous = current
+    if discarded > 0:
+        per_frame = (time() - start) / discarded
+        saved = (maximum - discarded) * per_frame
+        log.debug(f'Discarded {discarded} of {maximum} frames ({saved:.2f}s saved).')
+    return discarded
+
+
+def capture_concurrently(open_device, ports, release=True, timeout=10):
+    '''Open cameras in parallel and grab a frame from each at the same time.
+
+    Devices are released afterwards unless they belong to persistent sessions.
+    Errors opening a device are raised once every thread has finished.
+    '''
+    devices = [None] * len(ports)
+    grabbed = [False] * len(ports)
+    errors = []
+    barrier = threading.Barrier(len(ports))
+
+    def _grab(index, port):
+        try:
+            devices[index] = open_device(port)
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+            barrier.abort()
+            return
+        try:
+            barrier.wait(timeout)
+        except threading.BrokenBarrierError:
+            return
+        grabbed[index] = devices[index].grab()
+
+    threads = [threading.Thread(target=_grab, args=(index, port))
+               for index, port in enumerate(ports)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    frames = [device.retrieve() if ok else (False, None)
+              for device, ok in zip(devices, grabbed)]
+    if release:
+        for device in devices:
+            if device is not None:
+                device.release()
+    if errors:
+        raise errors[0]
+    return frames
+
+
+def select_sweep_frames(frames, samples, target, count=1, axis='y'):
+    'Return the recorded frames closest to the target axis coordinate.'
+    located = []
+    for frame in frames:
+        location = position_at(samples, frame['time'])
+        if location.get(axis) is None:
+            continue
+        error = abs(location[axis] - target)
+        located.append({**frame, 'location': location, 'error': error})
+    # Prefer later frames on ties: the gantry has been still for longer.
+    located.sort(key=lambda frame: (frame['error'], -frame['time']))
+    return located[:count]
+
+
+class Camera():
+    'Long-lived camera session with a background frame grabber.'
+
+    def __init__(self, cv, settings, log):
+        self.cv = cv
+        self.settings = settings
+        self.log = log
+        self.port = None
+        self.capture = None
+        self.thread = None
+        self.running = False
+        self.condition = threading.Condition()
+        self.frame = {'id': 0, 'ret': False, 'image': None, 'time': None}
+        self.warm_up_id = 0
+        self.grabbed = (False, None)
+        self.recording = None
+
+    def open(self, port, warm_up=0):
+        '''Open the camera device and start grabbing frames.
+
+        The first `warm_up` frames are discarded. Returns False if the
+        session was already open on this port.
+        '''
+        if self.running and port == self.port:
+            return False
+        self.release()
+        self.log.debug(f'Opening camera session on port {port}...')
+        self.port = port
+        self.capture = self.cv.VideoCapture(port)
+        width = self.settings['capture_width']
+        height = self.settings['capture_height']
+        self.capture.set(self.cv.CAP_PROP_FRAME_WIDTH, width)
+        self.capture.set(self.cv.CAP_PROP_FRAME_HEIGHT, height)
+        self.warm_up_id = self.frame['id'] + warm_up
+        self.running = True
+        self.thread = threading.Thread(target=self._grab_frames, daemon=True)
+        self.thread.start()
+        return True
+
+    def _grab_frames(self):
+        while self.running:
+            ret, image = self.capture.read()
+            with self.condition:
+                self.frame = {
+                    'id': self.frame['id'] + 1,
+                    'ret': ret,
+                    'image': image,
+                    'time': time(),
+                }
+                if ret and self.recording is not None:
+                    self.recording.append(self.frame)
+                self.condition.notify_all()
+            if not ret:
+                sleep(0.05)
+
+    def read(self, timeout=10):
+        'Return the first frame exposed entirely after the request.'
+        with self.condition:
+            # The frame in progress may have started before the request.
+            target = max(self.frame['id'] + 2, self.warm_up_id + 1)
+            fresh = self.condition.wait_for(
+                lambda: self.frame['id'] >= target or not self.running,
+                timeout)
+            if not fresh or not self.running:
+                return False, None
+            return self.frame['ret'], self.frame['image']
+
+    def grab(self, timeout=10):
+        'Wait for a fresh frame, to be returned by retrieve().'
+        self.grabbed = self.read(timeout)
+        return self.grabbed[0]
+
+    def retrieve(self):
+        'Return the frame from the last grab().'
+        return self.grabbed
+
+    def start_recording(self):
+        'Keep every grabbed frame until recording is stopped.'
+        with self.condition:
+            self.recording = []
+
+    def stop_recording(self):
+        'Stop recording and return the recorded frames.'
+        with self.condition:
+            frames = self.recording or []
+            self.recording = None
+        return frames
+
+    def release(self):
+        'Stop grabbing frames and release the camera device.'
+        if self.capture is None:
+            return
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.capture.release()
+        self.log.debug('Camera session released.')
+        self.capture = None
+        self.thread = None
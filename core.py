@@ -7,6 +7,7 @@ from settings import Settings
 from log import Log
 from results import Results
 from serial_device import SerialDevice
+from position import wait_for_position
 
 
 class Core():
@@ -27,6 +28,21 @@ def noop(*_, **__):
     'Do nothing.'
 
 
+def set_config_values(farmware_name, values):
+    'Set several Farmware config values with a single command.'
+    prefix = farmware_name.lower().replace(' ', '_')
+    body = [device.assemble_pair(f'{prefix}_{key}', str(value))
+            for key, value in values.items()]
+    device.send_celery_script(
+        {'kind': 'set_user_env', 'args': {}, 'body': body})
+
+
+def print_config_values(_farmware_name, values):
+    'Print Farmware config values.'
+    for key, value in values.items():
+        print(f'{key:<30} {value}')
+
+
 class Tools():
     'Farmware Tools wrapper.'
 
@@ -36,9 +52,11 @@ class Tools():
         self.app = App(quiet)
         self.get_config_value = get_config_value
         self.set_config_value = set_config_value
+        self.set_config_values = set_config_values
         if quiet:
             self.get_config_value = lambda *_: {}['raise']
             self.set_config_value = lambda _, k, v: print(f'{k:<30} {v}')
+            self.set_config_values = print_config_values
 
 
 class Env():
@@ -68,6 +86,12 @@ class Device():
             self.move_relative = lambda **kwargs: print(kwargs)
             self.write_pin = lambda **kwargs: print(kwargs)
 
+    def wait_for_position(self, expected=None, timeout=0.5, interval=0.05):
+        'Wait until the reported position is fresh and stable.'
+        self.read_status()
+        return wait_for_position(
+            self.get_current_position, expected, timeout, interval)
+
 
 class App():
     'Farmware Tools app wrapper.'
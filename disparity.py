@@ -0,0 +1,230 @@
+#!/usr/bin/env python3.8
+
+'Disparity engines.'
+
+import os
+import warnings
+from functools import partial
+from time import time
+import numpy as np
+import cv2 as cv
+from process_image import odd
+
+INVALID = -16
+
+
+class DisparityEngine():
+    'Compute fixed-point (pixels * 16) disparity for a stereo pair.'
+
+    name = None
+
+    def __init__(self, num_disparities, block_size, min_disparity=0):
+        self.num_disparities = num_disparities
+        self.block_size = block_size
+        self.min_disparity = min_disparity
+        self.invalid = INVALID
+
+    def _compute(self, left, right):
+        raise NotImplementedError
+
+    def compute(self, left, right):
+        'Return int16 disparity and timing and coverage metadata.'
+        start = time()
+        disparity = self._compute(left, right)
+        if self.min_disparity:
+            disparity[disparity < 16 * self.min_disparity] = INVALID
+        duration = time() - start
+        valid = np.count_nonzero(disparity > self.invalid)
+        return disparity, {
+            'engine': self.name,
+            'duration': round(duration, 4),
+            'coverage': round(100 * valid / disparity.size, 2),
+        }
+
+
+class StereoBMEngine(DisparityEngine):
+    'Block matching.'
+
+    def __init__(self, num_disparities, block_size, min_disparity=0):
+        super().__init__(num_disparities, block_size, min_disparity)
+        self.matcher = cv.StereoBM_create(num_disparities, block_size)
+        self.matcher.setMinDisparity(min_disparity)
+
+    def _compute(self, left, right):
+        return self.matcher.compute(left, right)
+
+
+class StereoSGBMEngine(DisparityEngine):
+    'Semi-global block matching.'
+
+    def __init__(self, num_disparities, block_size, min_disparity=0,
+                 mode=cv.STEREO_SGBM_MODE_SGBM):
+        super().__init__(num_disparities, block_size, min_disparity)
+        area = block_size * block_size
+        self.matcher = cv.StereoSGBM_create(
+            minDisparity=min_disparity, numDisparities=num_disparities,
+            blockSize=block_size, P1=8 * area, P2=32 * area,
+            uniquenessRatio=10, mode=mode)
+
+    def _compute(self, left, right):
+        return self.matcher.compute(left, right)
+
+
+class DownscaledEngine(DisparityEngine):
+    'Match at half resolution and scale the result back up.'
+
+    def __init__(self, num_disparities, block_size, min_disparity=0,
+                 engine=StereoBMEngine):
+        super().__init__(num_disparities, block_size, min_disparity)
+        half_disparities = max(16, -(-num_disparities // 32) * 16)
+        half_block_size = max(5, odd(block_size // 2))
+        self.engine = engine(half_disparities, half_block_size, min_disparity // 2)
+
+    def _compute(self, left, right):
+        half, _ = self.engine.compute(cv.pyrDown(left), cv.pyrDown(right))
+        height, width = left.shape[:2]
+        resized = cv.resize(half, (width, height),
+                            interpolation=cv.INTER_NEAREST)
+        return np.where(resized > self.invalid, resized * 2,
+                        self.invalid).astype(np.int16)
+
+
+class FlowEngine(DisparityEngine):
+    'Dense optical flow magnitude.'
+
+    def __init__(self, num_disparities=0, block_size=0, _min_disparity=0):
+        super().__init__(num_disparities, block_size)
+        self.matcher = cv.FarnebackOpticalFlow_create()
+
+    def flow(self, left, right):
+        'Return the per-pixel (dx, dy) flow from left to right.'
+        return self.matcher.calc(left, right, None)
+
+    def _compute(self, left, right):
+        results = self.flow(left, right)
+        magnitude = np.hypot(results[:, :, 0], results[:, :, 1]) * 16
+        return np.clip(magnitude, 0, np.iinfo(np.int16).max).astype(np.int16)
+
+
+ENGINES = {
+    'bm': StereoBMEngine,
+    'sgbm': StereoSGBMEngine,
+    'sgbm_fast': partial(StereoSGBMEngine, mode=cv.STEREO_SGBM_MODE_SGBM_3WAY),
+    'sgbm_quality': partial(StereoSGBMEngine, mode=cv.STEREO_SGBM_MODE_HH),
+    'bm_half': DownscaledEngine,
+    'flow': FlowEngine,
+}
+
+
+class Fusion():
+    'Combine disparity maps one at a time, counting valid values per pixel.'
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.count = None
+        self.total = 0
+
+    def add(self, disparity):
+        'Add a disparity map.'
+        valid = disparity >= self.threshold
+        if self.count is None:
+            self.count = np.zeros(disparity.shape, np.uint16)
+        self.count += valid
+        self.total += 1
+        self._add(disparity, valid)
+
+    def _add(self, disparity, valid):
+        raise NotImplementedError
+
+    def result(self):
+        'Return the fused int16 disparity.'
+        raise NotImplementedError
+
+    def confidence(self):
+        'Return the percent of maps with a valid value at each pixel.'
+        return (100 * self.count.astype(np.float32) / self.total).astype(np.uint8)
+
+
+class FillFusion(Fusion):
+    'Fill missing values from each subsequent map in turn.'
+
+    def __init__(self, threshold):
+        super().__init__(threshold)
+        self.data = None
+
+    def _add(self, disparity, valid):
+        if self.data is None:
+            self.data = disparity
+            return
+        missing = self.data < self.threshold
+        self.data[missing] = disparity[missing]
+
+    def result(self):
+        return self.data
+
+
+def _median(stack):
+    'Per-pixel median of int16 maps, ignoring INVALID values.'
+    values = np.stack(stack).astype(np.float32)
+    values[values == INVALID] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=0)
+    return np.where(np.isnan(median), INVALID, np.round(median)).astype(np.int16)
+
+
+class MedianFusion(Fusion):
+    '''Per-pixel median of valid values.
+
+    Uses a remedian: each full buffer of maps is reduced to its median and
+    passed up a level, so memory is bounded by buffer_size int16 maps per
+    level. Exact for up to buffer_size maps, apart from rounding.
+    '''
+
+    def __init__(self, threshold, buffer_size=9):
+        super().__init__(threshold)
+        self.buffer_size = buffer_size
+        self.levels = []
+
+    def _add(self, disparity, valid):
+        self._push(0, np.where(valid, disparity, INVALID).astype(np.int16))
+
+    def _push(self, level, values):
+        if level == len(self.levels):
+            self.levels.append([])
+        self.levels[level].append(values)
+        if len(self.levels[level]) == self.buffer_size:
+            median = _median(self.levels[level])
+            self.levels[level] = []
+            self._push(level + 1, median)
+
+    def result(self):
+        return _median([values for level in self.levels for values in level])
+
+
+FUSIONS = {
+    'fill': FillFusion,
+    'median': MedianFusion,
+}
+
+_CACHE = {}
+
+
+def get_engine(name, num_disparities=0, block_size=0, instance=0, min_disparity=0):
+    '''Return the process-wide engine for these matching parameters.
+
+    Engines are not thread-safe: concurrent workers each use their own instance.
+    '''
+    key = (name, num_disparities, block_size, instance, min_disparity)
+    if key not in _CACHE:
+        engine = ENGINES[name](num_disparities, block_size, min_disparity)
+        engine.name = name
+        _CACHE[key] = engine
+    return _CACHE[key]
+
+
+def set_thread_policy(workers, opencv_threads=-1):
+    'Split CPU cores between Python-level workers and OpenCV threads.'
+    if opencv_threads < 0 and workers > 1:
+        opencv_threads = max(1, (os.cpu_count() or 1) // workers)
+    cv.setNumThreads(opencv_threads)
@@ -3,6 +3,7 @@
 'Logging.'
 
 import sys
+import threading
 from time import time
 
 PREFIX = '[Measure Soil Height]'
@@ -17,6 +18,10 @@ class Log():
         self.start_time = None
         self.sent = []
         self.errors = []
+        self.batch = []
+        self.batch_lock = threading.RLock()
+        self.batch_timer = None
+        self.calls_saved = 0
 
     def add_pre_logs(self, pre_times):
         'Add logs created before init.'
@@ -41,13 +46,49 @@ class Log():
         'Log a message.'
         if self.settings['log_verbosity'] > 0 or log_type == 'error':
             message = self._add_elapsed_time(message, kwargs.get('log_time'))
-            self.device.log(message, message_type=log_type,
-                            channels=channels)
             self.sent.append({
                 'message': message,
                 'type': log_type,
                 'channels': channels,
             })
+            if log_type == 'debug' and channels is None:
+                self._add_to_batch(message)
+                return
+            self.flush()
+            self.device.log(message, message_type=log_type,
+                            channels=channels)
+
+    def _add_to_batch(self, message):
+        with self.batch_lock:
+            self.batch.append(message)
+            if len(self.batch) >= self.settings['log_batch_size']:
+                self.flush()
+            elif len(self.batch) == 1:
+                # Send a quiet tail after the interval instead of at close().
+                interval = self.settings['log_batch_interval']
+                self.batch_timer = threading.Timer(interval, self.flush)
+                self.batch_timer.daemon = True
+                self.batch_timer.start()
+
+    def flush(self):
+        'Send batched debug messages as a single log.'
+        with self.batch_lock:
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+            if not self.batch:
+                return
+            messages, self.batch = self.batch, []
+            self.calls_saved += len(messages) - 1
+            self.device.log('\n'.join(messages), message_type='debug',
+                            channels=None)
+
+    def close(self):
+        'Send any batched messages and report device calls saved.'
+        self.flush()
+        if self.settings['time'] and self.calls_saved > 0:
+            self.debug(f'Log batching saved {self.calls_saved} device calls.')
+            self.flush()
 
     def _add_elapsed_time(self, message, log_time=None):
         if self.settings['time']:
@@ -62,11 +103,15 @@ class Log():
         return message
 
     def debug(self, message, log_time=None, verbosity=3):
-        'Send error message.'
+        'Send debug message. Callable messages are only evaluated if used.'
+        if self.settings['log_verbosity'] < 1:
+            return
+        if callable(message):
+            message = message()
         if self.settings['log_verbosity'] >= verbosity:
             self.log(f'{PREFIX} {message}',
                      log_type='debug', log_time=log_time)
-        elif self.settings['log_verbosity'] > 0:
+        else:
             print(message)
 
     def error(self, message):
@@ -3,6 +3,8 @@
 '''Measure soil z height using OpenCV and FarmBot's current position.'''
 
 import traceback
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from time import time, sleep
 TIMES = {'start': time()}
@@ -10,6 +12,8 @@ if TIMES:
     import cv2 as cv
     TIMES['OpenCV imported.'] = time()
     from core import Core
+    from camera import Camera, discard_until_settled, select_sweep_frames
+    from camera import capture_concurrently, capture_quality
     from calculate_multiple import CalculateMultiple
 TIMES['imports_done'] = time()
 
@@ -29,34 +33,109 @@ class MeasureSoilHeight():
         self.cv = cv
         self.images = []
         self.expected_position = None
+        self.luma_only = self.core.settings.luma_only()
+        self.cameras = {}
+        self.calculations = None
+        self.pipeline = None
+        self.pending = []
 
-    def capture(self, port, timestamp, stereo_id, k=None):
-        'Capture image with camera.'
-        camera = self.cv.VideoCapture(port)
+    def camera_sessions(self):
+        'Check if cameras are kept open in persistent sessions.'
+        return bool(self.settings['persistent_camera']
+                    or self.settings['sweep_capture'])
+
+    def open_camera(self, port):
+        'Open a new camera device or reuse the persistent camera session.'
         settings = self.settings
+        adaptive = settings['adaptive_frame_discard']
+        if self.camera_sessions():
+            camera = self.cameras.get(port)
+            if camera is None:
+                camera = self.cameras[port] = Camera(self.cv, settings, self.log)
+            warm_up = 0 if adaptive else settings['frame_discard_count']
+            opened = camera.open(port, warm_up)
+            if adaptive and opened:
+                discard_until_settled(camera, settings, self.log, delay=0)
+            return camera
+        return self.open_device(port)
+
+    def open_device(self, port):
+        'Open a camera device and discard frames until exposure settles.'
+        settings = self.settings
+        camera = self.cv.VideoCapture(port)
         camera.set(self.cv.CAP_PROP_FRAME_WIDTH, settings['capture_width'])
         camera.set(self.cv.CAP_PROP_FRAME_HEIGHT, settings['capture_height'])
+        if settings['adaptive_frame_discard']:
+            discard_until_settled(camera, settings, self.log)
+            return camera
         for _ in range(settings['frame_discard_count']):
             camera.grab()
             sleep(0.1)
+        return camera
+
+    def release_camera(self):
+        'Release the persistent camera sessions.'
+        for camera in self.cameras.values():
+            camera.release()
+
+    def capture(self, port, timestamp, stereo_id, k=None):
+        'Capture image with camera.'
+        camera = self.open_camera(port)
         ret, image = camera.read()
         if not ret:
             self.log.error('Problem getting image.')
-        self.device.read_status()
-        sleep(settings['read_position_delay'])
-        location = self.device.get_current_position()
-        if settings['assume_target_reached']:
-            location = copy(self.expected_position)
+        image = self.check_capture(image, camera.read)
+        location = self.capture_location()
         self.log.debug(f'Image captured at {timestamp} {location}')
+        self.save_capture(image, timestamp, stereo_id, k)
+        return {'data': self.reduce_capture(image), 'tag': stereo_id,
+                'name': timestamp, 'location': location}
+
+    def capture_location(self):
+        'Return the location of a capture, waiting for the move to be reported.'
+        settings = self.settings
+        if settings['assume_target_reached']:
+            return copy(self.expected_position)
+        return self.device.wait_for_position(
+            self.expected_position or None,
+            timeout=settings['read_position_delay'],
+            interval=settings['read_position_interval'])
+
+    def reduce_capture(self, image):
+        'Keep only the luma channel of a capture when color is not needed.'
+        if self.luma_only and len(image.shape) > 2:
+            return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        return image
+
+    def check_capture(self, image, recapture=None):
+        'Recapture or abort before moving on if the image is dark or blurry.'
+        settings = self.settings
+        if not settings['capture_quality_check']:
+            return image
+        retries = settings['capture_retry_count'] if recapture else 0
+        for attempt in range(retries + 1):
+            quality = capture_quality(image, settings)
+            self.log.debug(quality['report'])
+            if quality['ok']:
+                return image
+            if attempt < retries:
+                self.log.debug('Poor capture quality. Recapturing...')
+                ret, image = recapture()
+                if not ret:
+                    self.log.error('Problem getting image.')
+        self.log.error('Not enough detail. Check recent images.')
+        return image
+
+    def save_capture(self, image, timestamp, stereo_id, k=None):
+        'Save captured image according to image output settings.'
         image_save_option = self.core.settings.images
         single = stereo_id == 'left' and image_save_option['single_input']
-        if settings['capture_only'] or single or image_save_option['inputs']:
+        if self.settings['capture_only'] or single or image_save_option['inputs']:
             if self.settings['capture_count_at_each_location'] == 1:
                 k = None
             id_ = f'_{k}' if k is not None else ''
-            self.results.save_image(f'{stereo_id}{id_}', image)
-        return {'data': image, 'tag': stereo_id,
-                'name': timestamp, 'location': location}
+            self.results.save_image(f'{stereo_id}{id_}', image,
+                                    title=f'{timestamp}_')
 
     def location_captures(self, i, stereo_id, timestamp):
         'Capture images at position.'
@@ -67,34 +146,141 @@ class MeasureSoilHeight():
             capture_data = self.capture(port, timestamp, stereo_id, k)
             self.images[i][stereo_id].append(capture_data)
 
-    def capture_images(self):
-        'Capture stereo images, calculate soil height, and save to account.'
-        if self.settings['use_lights']:
-            self.device.write_pin(pin_number=7, pin_value=1, pin_mode=0)
+    def sweep_captures(self, i, stereo_id, timestamp, y_relative, speed):
+        'Record frames during the stereo move and keep those at the baseline.'
+        settings = self.settings
+        target = self.expected_position.get('y')
+        if target is None:
+            self.log.debug('Sweep unavailable. Capturing after move...')
+            self.device.move_relative(x=0, y=-y_relative, z=0, speed=speed)
+            self.location_captures(i, stereo_id, timestamp)
+            return
+        self.log.debug(f'Sweeping to capture {stereo_id} image...', verbosity=2)
+        camera = self.open_camera(int(settings['camera_port']))
+        interval = settings['read_position_interval']
+        samples = [{'time': time(),
+                    'position': self.device.get_current_position()}]
+        camera.start_recording()
+        move = threading.Thread(
+            target=self.device.move_relative,
+            kwargs={'x': 0, 'y': -y_relative, 'z': 0, 'speed': speed})
+        move.start()
+        while move.is_alive():
+            sleep(interval)
+            samples.append({'time': time(),
+                            'position': self.device.get_current_position()})
+        move.join()
+        location = self.device.wait_for_position(
+            self.expected_position or None,
+            timeout=settings['read_position_delay'], interval=interval)
+        samples.append({'time': time(), 'position': location})
+        count = settings['capture_count_at_each_location']
+        for _ in range(count):
+            camera.read()
+        frames = select_sweep_frames(
+            camera.stop_recording(), samples, target, count)
+        misses = [f for f in frames if f['error'] > settings['sweep_tolerance_mm']]
+        if len(frames) < count or misses:
+            self.log.debug('No frames at baseline. Capturing after move...')
+            self.location_captures(i, stereo_id, timestamp)
+            return
+        for k, frame in enumerate(frames):
+            self.check_capture(frame['image'])
+            location = frame['location']
+            if settings['assume_target_reached']:
+                location = copy(self.expected_position)
+            self.log.debug(f'Image selected at {timestamp} {location}')
+            self.save_capture(frame['image'], timestamp, stereo_id, k)
+            image = self.reduce_capture(frame['image'])
+            self.images[i][stereo_id].append({
+                'data': image, 'tag': stereo_id,
+                'name': timestamp, 'location': location})
 
-        needs_calibration = self.settings['calibration_factor'] == 0
-        use_sets = needs_calibration or self.settings['force_sets']
-        sets = self.settings['number_of_stereo_sets'] if use_sets else 1
+    def dual_captures(self, i, timestamp):
+        'Capture left and right images concurrently with two cameras.'
+        self.log.debug('Capturing left and right images...', verbosity=2)
+        settings = self.settings
+        ports = [int(settings['camera_port']), int(settings['right_camera_port'])]
+        image_order = ['left', 'right']
+        if settings['reverse_image_order']:
+            image_order = image_order[::-1]
+        for k in range(settings['capture_count_at_each_location']):
+            sleep(settings['repeat_capture_delay_s'])
+            frames = capture_concurrently(
+                self.open_camera, ports, release=not self.camera_sessions())
+            if not all(ret for ret, _image in frames):
+                self.log.error('Problem getting image.')
+            for _ret, image in frames:
+                self.check_capture(image)
+            location = self.capture_location()
+            self.log.debug(f'Images captured at {timestamp} {location}')
+            for stereo_id, (_ret, image) in zip(image_order, frames):
+                self.save_capture(image, timestamp, stereo_id, k)
+                self.images[i][stereo_id].append({
+                    'data': self.reduce_capture(image), 'tag': stereo_id,
+                    'name': timestamp, 'location': location})
+
+    def _calculate_set(self, i, title):
+        self.core.settings.title = title
+        if self.calculations is None:
+            self.calculations = CalculateMultiple(self.core, self.images)
+        self.calculations.calculate_set(i)
+
+    def start_calculation(self, i, timestamp):
+        'Calculate a captured set in the background while capturing continues.'
+        if self.pipeline is None:
+            return
+        self.log.debug(f'Queueing calculations for set {i}...')
+        self.pending.append(
+            self.pipeline.submit(self._calculate_set, i, f'{timestamp}_'))
+
+    def check_calculations(self):
+        'Raise any errors from completed background calculations.'
+        for calculation in self.pending:
+            if calculation.done():
+                calculation.result()
+
+    def calibration_converged(self, i):
+        'Check if the remaining stereo sets can be skipped.'
+        settings = self.settings
+        if self.pipeline is None or not settings['early_calibration_stop']:
+            return False
+        if i < settings['minimum_stereo_sets']:
+            return False
+        for calculation in self.pending:
+            calculation.result()
+        converged = self.calculations.fit_converged()
+        if converged:
+            self.log.debug(f'Calibration converged after {i} sets.', verbosity=2)
+        return converged
+
+    def capture_sets(self, sets, to_start):
+        'Capture each stereo set, recording the moves needed to return.'
         image_order = ['left', 'right']
         if self.settings['reverse_image_order']:
             image_order = image_order[::-1]
         speed = self.settings['movement_speed_percent']
-        to_start = {'x': 0, 'y': 0, 'z': 0}
-        self.expected_position = copy(self.settings['initial_position'])
-
         flip = True
         for i in range(sets):
+            if self.calibration_converged(i):
+                break
             self.images.append({'left': [], 'right': []})
             timestamp = str(int(time()))
-            self.core.settings.title = f'{timestamp}_'
+            if self.pipeline is None:
+                self.core.settings.title = f'{timestamp}_'
 
             if i > 0:
+                self.check_calculations()
                 z_direction = -1 if self.settings['negative_z'] else 1
                 z_relative = z_direction * self.settings['set_offset_mm']
                 if self.expected_position.get('z') is not None:
                     self.expected_position['z'] += z_relative
                 to_start['z'] -= z_relative
                 self.device.move_relative(x=0, y=0, z=z_relative, speed=speed)
+            if self.settings['dual_camera']:
+                self.dual_captures(i, timestamp)
+                self.start_calculation(i, timestamp)
+                continue
             stereo_id = image_order[int(not flip)]
             self.location_captures(i, stereo_id, timestamp)
 
@@ -102,21 +288,66 @@ class MeasureSoilHeight():
             if self.expected_position.get('y') is not None:
                 self.expected_position['y'] -= y_relative
             to_start['y'] += y_relative
-            self.device.move_relative(x=0, y=-y_relative, z=0, speed=speed)
             stereo_id = image_order[int(flip)]
-            self.location_captures(i, stereo_id, timestamp)
+            if self.settings['sweep_capture']:
+                self.sweep_captures(i, stereo_id, timestamp, y_relative, speed)
+            else:
+                self.device.move_relative(x=0, y=-y_relative, z=0, speed=speed)
+                self.location_captures(i, stereo_id, timestamp)
+            self.start_calculation(i, timestamp)
             flip = not flip
 
-        if self.settings['use_lights']:
-            self.device.write_pin(pin_number=7, pin_value=0, pin_mode=0)
-        self.log.debug('Returning to starting position...', verbosity=2)
-        self.device.move_relative(
-            x=to_start['x'],
-            y=to_start['y'],
-            z=to_start['z'], speed=speed)
+    def capture_images(self):
+        'Capture stereo images, calculate soil height, and save to account.'
+        pipelined = self.settings['pipeline_calculations']
+        pipelined = pipelined or self.settings['early_calibration_stop']
+        if pipelined and not self.settings['capture_only']:
+            self.pipeline = ThreadPoolExecutor(max_workers=1)
+            self.calculations = None
+            self.pending = []
+
+        needs_calibration = self.settings['calibration_factor'] == 0
+        use_sets = needs_calibration or self.settings['force_sets']
+        sets = self.settings['number_of_stereo_sets'] if use_sets else 1
+        if needs_calibration and self.core.settings.analytical_calibration():
+            sets = sets if self.settings['force_sets'] else 1
+        to_start = {'x': 0, 'y': 0, 'z': 0}
+        self.expected_position = copy(self.settings['initial_position'])
+
+        try:
+            if self.settings['use_lights']:
+                self.device.write_pin(pin_number=7, pin_value=1, pin_mode=0)
+            self.capture_sets(sets, to_start)
+        except BaseException:
+            self.shutdown_pipeline()
+            raise
+        finally:
+            # Runs on errors too (log.error exits) so the gantry and lights are restored.
+            self.release_camera()
+            if self.settings['use_lights']:
+                self.device.write_pin(pin_number=7, pin_value=0, pin_mode=0)
+            self.log.debug('Returning to starting position...', verbosity=2)
+            self.device.move_relative(
+                x=to_start['x'],
+                y=to_start['y'],
+                z=to_start['z'], speed=self.settings['movement_speed_percent'])
+
+    def shutdown_pipeline(self):
+        'Wait for queued background calculations and stop the pipeline.'
+        if self.pipeline is not None:
+            self.pipeline.shutdown()
+            self.pipeline = None
 
     def calculate(self):
         'Calculate soil height.'
+        if self.pipeline is not None:
+            try:
+                for calculation in self.pending:
+                    calculation.result()
+            finally:
+                self.shutdown_pipeline()
+            self.calculations.summarize()
+            return
         if not self.settings['capture_only']:
             calculations = CalculateMultiple(self.core, self.images)
             calculations.calculate_multiple()
@@ -135,3 +366,8 @@ if __name__ == '__main__':
         exc = exc.replace('\n', '<br>')
         msg += f'<details><pre>{exc}</pre></details>'
         measure_soil.log.error(msg)
+    finally:
+        measure_soil.release_camera()
+        if not measure_soil.results.flush(timeout=30):
+            print('Unsent results kept in the outbox for the next run.')
+        measure_soil.log.close()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3.8
+
+'Position helpers.'
+
+from time import time, sleep
+import numpy as np
+
+
+def positions_match(position, expected, tolerance=1):
+    'Check if a position matches the expected coordinates.'
+    if not position or not expected:
+        return False
+    for axis, value in expected.items():
+        if value is None:
+            continue
+        if position.get(axis) is None:
+            return False
+        if abs(float(position[axis]) - float(value)) > tolerance:
+            return False
+    return True
+
+
+def wait_for_position(get_position, expected=None, timeout=0.5, interval=0.05,
+                      stable_count=2):
+    '''Poll position until it matches the expected target or stops changing.
+
+    Without an expected target, a position unchanged for `stable_count`
+    polls is accepted. With one, only a match is accepted: a stale report
+    can stay unchanged before the move is reported.
+    Returns the last reported position, even if the timeout was reached.
+    '''
+    start = time()
+    previous = None
+    unchanged = 0
+    while True:
+        position = get_position()
+        if positions_match(position, expected):
+            return position
+        unchanged = unchanged + 1 if position == previous else 0
+        if expected is None and unchanged >= stable_count:
+            return position
+        if (time() - start) >= timeout:
+            return position
+        previous = position
+        sleep(interval)
+
+
+def position_at(samples, timestamp):
+    'Interpolate timestamped position samples at the provided time.'
+    position = {}
+    for axis in ['x', 'y', 'z']:
+        known = [(sample['time'], sample['position'][axis]) for sample in samples
+                 if (sample['position'] or {}).get(axis) is not None]
+        if len(known) < 1:
+            continue
+        times, values = zip(*known)
+        position[axis] = float(np.interp(timestamp, times, values))
+    return position
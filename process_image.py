@@ -2,6 +2,7 @@
 
 'Image processing.'
 
+import zlib
 import numpy as np
 import cv2 as cv
 from reduce_data import ReduceData
@@ -45,6 +46,17 @@ class ProcessImage():
         self.saved = False
         self.angle = angle
 
+    @property
+    def image(self):
+        'Image data. Preprocess output is cached until the image changes.'
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.preprocessed = {}
+        self.fingerprint = None
+
     def reduce_data(self, **kwargs):
         'Generate reduced data.'
         self.data = ReduceData(self.core, self.image, self.info, **kwargs)
@@ -61,15 +73,25 @@ class ProcessImage():
         self.image = self.rotate_copy(direction=direction)
 
     def preprocess(self, perform_rotation=True):
-        'Return pre-processed image.'
+        'Return pre-processed image. The result is shared, so do not modify it.'
         self.show()
-        image = self.image.copy()
-        gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
         blur = odd(self.settings['blur'])
-        blurred = cv.medianBlur(gray, blur) if blur else gray
-        rotated = self.rotate_copy(blurred) if perform_rotation else blurred
-        self.show(rotated)
-        return rotated
+        key = (blur, self.angle if perform_rotation else None)
+        # Catches in-place edits, which bypass the image setter.
+        fingerprint = zlib.adler32(np.ascontiguousarray(self.image))
+        if fingerprint != self.fingerprint:
+            self.preprocessed = {}
+            self.fingerprint = fingerprint
+        if key not in self.preprocessed:
+            if len(self.image.shape) > 2:
+                gray = cv.cvtColor(self.image, cv.COLOR_BGR2GRAY)
+            else:
+                gray = self.image.copy()
+            blurred = cv.medianBlur(gray, blur) if blur else gray
+            rotated = self.rotate_copy(blurred) if perform_rotation else blurred
+            self.preprocessed[key] = rotated
+        self.show(self.preprocessed[key])
+        return self.preprocessed[key]
 
     def select_plants(self):
         'Select plants.'
@@ -4,9 +4,78 @@
 
 import os
 import json
+import threading
 import cv2 as cv
 
 
+class Outbox():
+    'Send queued writes on a background thread, keeping unsent ones on disk.'
+
+    def __init__(self, send, path, log):
+        self.send = send
+        self.path = path
+        self.log = log
+        self.condition = threading.Condition()
+        self.pending = self._load()
+        self.sending = False
+        self.failed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, 'r') as outbox_file:
+                return json.load(outbox_file)
+        except ValueError:
+            self.log.debug(f'Discarding corrupt results outbox {self.path}.')
+            return []
+
+    def _save(self):
+        if not self.pending:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        with open(self.path, 'w') as outbox_file:
+            json.dump(self.pending, outbox_file, default=str)
+
+    def put(self, *items):
+        'Queue writes.'
+        with self.condition:
+            self.pending.extend(items)
+            self._save()
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                items = list(self.pending)
+                self.sending = True
+            try:
+                self.send(items)
+            except Exception as error:
+                self.log.debug(f'Unsent results kept for the next run: {error}')
+                with self.condition:
+                    self.sending = False
+                    self.failed = True
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.pending = self.pending[len(items):]
+                self._save()
+                self.sending = False
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        'Wait until queued writes have been sent. Return False if any remain.'
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.failed or not (self.pending or self.sending),
+                timeout) and not self.failed
+
+
 class Results():
     'Save results.'
 
@@ -19,29 +88,63 @@ class Results():
             'farmware_env': [], 'points': [], 'images': [], 'data': [],
             'logs': self.log.sent, 'fbos_config': [],
         }
+        self.outbox = None
+        if self.settings['results_outbox']:
+            self.outbox = Outbox(
+                self.send, self.settings['results_outbox_file'], self.log)
 
-    def save_config(self, key):
-        'Save config value.'
+    def send(self, items, combine=True):
+        'Send writes, combining config values into a single command if requested.'
+        farmware_name = self.settings['farmware_name']
+        configs = {item['key']: item['value'] for item in items
+                   if item['kind'] == 'config'}
+        if configs and combine:
+            self.tools.set_config_values(farmware_name, configs)
+        for item in items:
+            if item['kind'] == 'config' and not combine:
+                self.tools.set_config_value(
+                    farmware_name, item['key'], item['value'])
+            if item['kind'] == 'patch':
+                self.tools.app.patch(item['endpoint'], payload=item['payload'])
+            if item['kind'] == 'post':
+                self.tools.app.post(item['endpoint'], item['payload'])
+
+    def write(self, *items):
+        'Queue writes if the outbox is enabled. Otherwise send them now.'
+        if self.outbox is not None:
+            self.outbox.put(*items)
+        else:
+            self.send(items, combine=False)
+
+    def flush(self, timeout=None):
+        'Wait for queued writes. Return False if any remain.'
+        if self.outbox is None:
+            return True
+        return self.outbox.flush(timeout)
+
+    def save_config(self, *keys):
+        'Save config values.'
         farmware_name = self.settings['farmware_name']
         farmware_name_lower = farmware_name.lower().replace(' ', '_')
-        value = self.settings[key]
-        self.tools.set_config_value(farmware_name, key, value)
-        self.saved['farmware_env'].append({
-            'key': f'{farmware_name_lower}_{key}',
-            'value': value,
-        })
+        self.write(*[{'kind': 'config', 'key': key, 'value': self.settings[key]}
+                     for key in keys])
+        for key in keys:
+            self.saved['farmware_env'].append({
+                'key': f'{farmware_name_lower}_{key}',
+                'value': self.settings[key],
+            })
 
     def save_calibration(self):
         'Save calculated calibration results.'
         keys = [k for k in self.settings if k.startswith('calibration_')]
-        for key in keys:
-            self.save_config(key)
+        self.save_config(*keys)
 
     def save_soil_height(self, soil_z):
         'Save soil height.'
         if self.settings['edit_fbos_config']:
             fbos_config_update = {'soil_height': soil_z}
-            self.tools.app.patch('fbos_config', payload=fbos_config_update)
+            self.write({'kind': 'patch', 'endpoint': 'fbos_config',
+                        'payload': fbos_config_update})
             self.saved['fbos_config'].append(fbos_config_update)
         if self.settings['save_point']:
             soil_height_point = {
@@ -57,17 +160,20 @@ class Results():
                     'color': 'gray',
                 },
             }
-            self.tools.app.post('points', soil_height_point)
+            self.write({'kind': 'post', 'endpoint': 'points',
+                        'payload': soil_height_point})
             self.saved['points'].append(soil_height_point)
         self.log.log(f'Soil height saved: {soil_z}',
                      log_type='success', channels=['toast'])
 
-    def save_image(self, name, image):
+    def save_image(self, name, image, title=None):
         'Save image.'
         images_dir = self.settings['images_dir']
         if not os.path.exists(images_dir):
             os.mkdir(images_dir)
-        filepath = f'{images_dir}/{self.settings_class.title}{name}.jpg'
+        if title is None:
+            title = self.settings_class.title
+        filepath = f'{images_dir}/{title}{name}.jpg'
         cv.imwrite(filepath, image)
         filesize = f'{os.path.getsize(filepath) / 1024.:.1f} KiB'
         self.saved['images'].append({'path': filepath, 'size': filesize})
@@ -2,29 +2,114 @@
 
 'Serial device.'
 
+import os
+import json
+import threading
+from concurrent.futures import Future, TimeoutError as ResponseTimeout
 from time import time
 import serial
 from settings import Settings
+from position import wait_for_position
+from serial_trace import RecordingSerial
+
+MAX_IN_FLIGHT = 4  # stay well inside the firmware's serial receive buffer
+SPEED_PARAMS = {'x': 71, 'y': 72, 'z': 73}
+CACHE_SENTINEL = 71  # always read; a cache that disagrees is re-read in full
+
+
+class FirmwareState():
+    'Latest firmware reports, updated by the serial reader thread.'
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.position = None
+        self.status = None
+        self.status_report = 0
+        self.reports = 0
+
+    def update(self, line):
+        'Parse a firmware report line.'
+        words = line.split(b' ')
+        code = words[0].decode(errors='replace')
+        with self.condition:
+            if code == 'R82':
+                try:
+                    self.position = {axis: float(word[1:]) for axis, word
+                                     in zip(['x', 'y', 'z'], words[1:4])}
+                except ValueError:
+                    pass
+            self.reports += 1
+            if code in ['R00', 'R01', 'R02', 'R03', 'R88']:
+                self.status = code
+                self.status_report = self.reports
+            self.condition.notify_all()
+
+    def get_position(self):
+        'Return the last reported position, if any.'
+        with self.condition:
+            return None if self.position is None else dict(self.position)
+
+    def clear_position(self):
+        'Forget the last reported position.'
+        with self.condition:
+            self.position = None
+
+    def wait_for_status(self, statuses, timeout, since=0):
+        'Wait for one of the statuses reported after report number `since`.'
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.status_report > since and self.status in statuses,
+                timeout)
 
 
 class SerialDevice():
     'Communicate with a device over serial.'
 
-    def __init__(self, settings):
+    def __init__(self, settings, transport=None):
         self.verbosity = settings['log_verbosity'] - 1
         self.log('Setting up serial connection...', verbosity=1)
-        port = settings['serial_port']
+        self.port = settings['serial_port']
         baud = settings['serial_baud_rate']
         self.timeout = 10
-        self.serial = serial.Serial(port, baud, timeout=self.timeout)
+        self.serial = transport or serial.Serial(self.port, baud, timeout=0.1)
+        if settings['serial_trace']:
+            self.serial = RecordingSerial(self.serial, settings['serial_trace'])
         self.buffer = b''
-        self.get(['ARDUINO STARTUP COMPLETE'])
+        self.state = FirmwareState()
+        self.lock = threading.Condition()
+        self.waiters = []
+        self.requests = {}
+        self.tag = 0
+        self.sent_report = 0
+        self.running = True
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        startup = self.expect(['ARDUINO STARTUP COMPLETE'])
+        self.reader.start()
+        self.result(startup)
         self.speed = {}
-        self.get_speeds()
-        if settings['serial_z_negative']:
-            self.send('F22 P53 V1')
+        self.params = {}
+        self.cache_file = settings['serial_param_cache']
+        cached = self.load_param_cache()
+        version = self.send_async('F83')
+        reset = None
         if settings['serial_reset_position']:
-            self.send('F84 X1 Y1 Z1')
+            reset = self.send_async('F84 X1 Y1 Z1')
+        extra = [53] if settings['serial_z_negative'] else []
+        reads = [CACHE_SENTINEL] if cached else [*SPEED_PARAMS.values(), *extra]
+        self.read_params(reads)
+        self.version = b' '.join(self.result(version) or []).decode()
+        self.log(f'firmware version: {self.version}')
+        self.get_speeds(cached, extra)
+        invert_z = None
+        if settings['serial_z_negative'] and self.params.get(53) != 1:
+            invert_z = self.send_async('F22 P53 V1')
+        if invert_z is not None:
+            self.result(invert_z)
+            self.params[53] = 1
+        if reset is not None:
+            self.result(reset)
+            self.state.clear_position()
+        self.save_param_cache()
         self.validate_params()
 
     def log(self, message, **kwargs):
@@ -33,68 +118,191 @@ class SerialDevice():
         if self.verbosity >= kwargs.get('verbosity', 2) or error:
             print(message)
 
+    def send_async(self, command):
+        'Send a command without waiting. Return a future for its response.'
+        code = command.split(' ')[0][1:]
+        if code == '22':
+            code = '21'
+        with self.lock:
+            self.lock.wait_for(lambda: len(self.requests) < MAX_IN_FLIGHT)
+            self.tag = self.tag % 99 + 1
+            request = {'command': command, 'response': bytes(f'R{code}', 'utf-8'),
+                       'value': [], 'future': Future()}
+            self.requests[self.tag] = request
+            self.sent_report = self.state.reports
+            if command.startswith('G'):
+                self.state.clear_position()
+            self.log(f'Sending {command} Q{self.tag}...')
+            self.serial.write(bytes(f'{command} Q{self.tag}\r\n', 'utf-8'))
+        return request['future']
+
     def send(self, command, wait_for_response=True):
         'Send a command'
-        self.log(f'Sending {command}...')
-        self.serial.write(bytes(command + '\r\n', 'utf-8'))
-        self.get([command])
+        request = self.send_async(command)
         if wait_for_response:
-            code = command.split(' ')[0][1:]
-            if code == '22':
-                code = '21'
-            if code in ['00', '41']:
-                self.get(['R02'])
-            else:
-                self.get([f'R{code}'])
+            return self.result(request)
+        return request
+
+    def _read_lines(self):
+        'Read all available bytes and return any complete lines.'
+        chunk = self.serial.read(self.serial.in_waiting or 1)
+        if b'\n' not in chunk:
+            self.buffer += chunk
+            return []
+        *lines, self.buffer = (self.buffer + chunk).split(b'\r\n')
+        return lines
+
+    def _read_loop(self):
+        while self.running:
+            try:
+                lines = self._read_lines()
+            except serial.SerialException as error:
+                self.log(f'Serial read failed: {error}', message_type='error')
+                self.running = False
+                lines = []
+            for line in lines:
+                self.state.update(line)
+                self._dispatch(line)
+
+    def _dispatch(self, line):
+        words = line.split(b' ')
+        with self.lock:
+            for waiter in list(self.waiters):
+                if not any(resp in line for resp in waiter['responses']):
+                    continue
+                if waiter['ignore_repeat'] and b'R08' in line:
+                    continue
+                self.waiters.remove(waiter)
+                waiter['future'].set_result(words[1:-1])
+            try:
+                tag = int(words[-1][1:]) if words[-1][:1] == b'Q' else None
+            except ValueError:
+                tag = None
+            request = self.requests.get(tag)
+            if request is None:
+                return
+            if words[0] == request['response']:
+                request['value'] = words[1:-1]
+            if words[0] not in [b'R02', b'R03']:
+                return
+            del self.requests[tag]
+            self.lock.notify_all()
+        if words[0] == b'R03':
+            self.log(f"{request['command']} failed.", message_type='error')
+            request['future'].set_result(None)
+        else:
+            request['future'].set_result(request['value'])
+
+    def close(self):
+        'Wait for commands in flight, then stop the reader and close the port.'
+        with self.lock:
+            self.lock.wait_for(lambda: not self.requests, self.timeout)
+        self.running = False
+        self.reader.join()
+        self.serial.close()
+
+    def expect(self, responses, ignore_repeat=False):
+        'Return a future for the next line containing one of the responses.'
+        waiter = {'responses': [bytes(resp, 'utf-8') for resp in responses],
+                  'ignore_repeat': ignore_repeat, 'future': Future()}
+        with self.lock:
+            self.waiters.append(waiter)
+        return waiter['future']
+
+    def result(self, future):
+        'Wait for a response. Return None on timeout.'
+        start = time()
+        while True:
+            try:
+                value = future.result(timeout=0.1)
+            except ResponseTimeout:
+                if self.verbosity > 2:
+                    print('.', end='', flush=True)
+                if (time() - start) > self.timeout:
+                    print('timeout')
+                    self._forget(future)
+                    return None
+                continue
+            self.log(f'received {value}')
+            return value
+
+    def _forget(self, future):
+        with self.lock:
+            self.waiters = [w for w in self.waiters if w['future'] is not future]
+            for tag, request in list(self.requests.items()):
+                if request['future'] is future:
+                    del self.requests[tag]
+            self.lock.notify_all()
 
     def get(self, responses, ignore_repeat=False):
         'Fetch a response from serial.'
         self.log(f'Waiting for {responses}...')
-        bytes_responses = [bytes(response, 'utf-8') for response in responses]
-        found = False
-        start = time()
-        last_dot = start - 0.11
-        while True:
-            if self.verbosity > 2:
-                since_last = time() - last_dot
-                if since_last > 0.1:
-                    print('.' * int(since_last * 10), end='', flush=True)
-                    last_dot = time()
-            if (time() - start) > self.timeout:
-                print('timeout')
-                return None
-            self.buffer += self.serial.read()
-            if any(self.buffer.endswith(resp) for resp in bytes_responses):
-                found = True
-            if found and self.buffer.endswith(b'\r\n'):
-                last = self.buffer.split(b'\r\n')[-2]
-                if ignore_repeat and b'R08' in last:
-                    found = False
-                    self.buffer = b''
-                    continue
-                value = last.split(b' ')[1:-1]
-                self.log(f'received {value}')
-                self.buffer = b''
-                return value
+        return self.result(self.expect(responses, ignore_repeat))
 
     def validate_params(self):
         'Validate firmware parameters.'
         self.log('Validating firmware parameters...')
-        self.send('F83')
-        self.get(['R00', 'R88'])
+        self.state.wait_for_status(['R00', 'R88'], self.timeout, self.sent_report)
         self.send('F22 P2 V1')
 
-    def get_speeds(self):
-        'Get axis speed values.'
+    def read_params(self, params):
+        'Read firmware parameter values concurrently.'
+        requests = {param: self.send_async(f'F21 P{param}') for param in params}
+        for param, request in requests.items():
+            self.params[param] = int(self.result(request)[1].strip(b'V'))
+
+    def get_speeds(self, cached=None, extra=()):
+        '''Get axis speed values and any extra parameters.
+
+        Cached values are used if the firmware version and the sentinel
+        parameter still match. Otherwise every parameter is read again.
+        '''
         self.log('Fetching firmware parameters...')
-        for axis, param in {'x': 71, 'y': 72, 'z': 73}.items():
-            self.send(f'F21 P{param}', wait_for_response=False)
-            self.speed[axis] = int(self.get(['R21'])[1].strip(b'V'))
+        params = [*SPEED_PARAMS.values(), *extra]
+        if cached is not None:
+            current = (cached.get('version') == self.version
+                       and cached['params'].get(str(CACHE_SENTINEL))
+                       == self.params.get(CACHE_SENTINEL))
+            for param in params if current else []:
+                if str(param) in cached['params']:
+                    self.params.setdefault(param, cached['params'][str(param)])
+            if not current:
+                self.log('Cached firmware parameters were stale.')
+        self.read_params([param for param in params if param not in self.params])
+        self.speed = {axis: self.params[p] for axis, p in SPEED_PARAMS.items()}
+
+    def load_param_cache(self):
+        'Load cached firmware parameters for this port.'
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                return json.load(cache_file).get(self.port)
+        except ValueError:
+            self.log('Ignoring corrupt firmware parameter cache.')
+            return None
+
+    def save_param_cache(self):
+        'Save firmware parameters for this port and firmware version.'
+        if not self.cache_file:
+            return
+        cache = {}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as cache_file:
+                    cache = json.load(cache_file)
+            except ValueError:
+                cache = {}
+        params = {str(param): value for param, value in self.params.items()}
+        cache[self.port] = {'version': self.version, 'params': params}
+        with open(self.cache_file, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2)
 
     def wait_for_idle(self):
         'Wait for idle response.'
         self.log('Waiting for idle...')
-        self.get(['R00'])
+        if not self.state.wait_for_status(['R00'], self.timeout, self.sent_report):
+            print('timeout')
 
     @staticmethod
     def read_status():
@@ -102,12 +310,18 @@ class SerialDevice():
 
     def get_current_position(self):
         'Get current device coordinates.'
-        self.send('F82', wait_for_response=False)
-        position = [float(r[1:]) for r in self.get(['R82'])]
-        coordinate = {'x': position[0], 'y': position[1], 'z': position[2]}
+        coordinate = self.state.get_position()
+        if coordinate is None:
+            position = [float(r[1:]) for r in self.send('F82')]
+            coordinate = {'x': position[0], 'y': position[1], 'z': position[2]}
         self.log(f'current position: {coordinate}')
         return coordinate
 
+    def wait_for_position(self, expected=None, timeout=0.5, interval=0.05):
+        'Wait until the reported position is stable.'
+        return wait_for_position(
+            self.get_current_position, expected, timeout, interval)
+
     def move_relative(self, x, y, z, speed):
         'Relative movement.'
         position = self.get_current_position()
@@ -125,10 +339,11 @@ class SerialDevice():
     def write_pin(self, pin_number, pin_value, pin_mode):
         'Write pin value.'
         self.log(f'Setting pin {pin_number} to {pin_value}')
-        self.send(f'F41 P{pin_number} V{pin_value} M{pin_mode}')
+        return self.send(f'F41 P{pin_number} V{pin_value} M{pin_mode}')
 
 
 if __name__ == '__main__':
     device = SerialDevice(Settings().settings)
     print(device.get_current_position())
     device.move_relative(0, 0, 0, 50)
+    device.close()
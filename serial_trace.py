@@ -0,0 +1,155 @@
+#!/usr/bin/env python3.8
+
+'''Serial traffic recording and replay.
+
+Trace files hold one event per line: `<seconds> <r|w> <hex bytes>`,
+timed from when the port was opened.
+'''
+
+import sys
+import threading
+from time import monotonic
+
+
+def load_trace(path):
+    'Load trace events as (time, direction, data) tuples.'
+    events = []
+    with open(path, 'r') as trace_file:
+        for line in trace_file:
+            timestamp, direction, data = line.split()
+            events.append((float(timestamp), direction, bytes.fromhex(data)))
+    return events
+
+
+class RecordingSerial():
+    'Pass traffic through to a serial transport and record it.'
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.trace_file = open(path, 'w', buffering=1)
+        self.start = monotonic()
+        self.lock = threading.Lock()
+
+    def _record(self, direction, data):
+        if not data:
+            return
+        timestamp = monotonic() - self.start
+        with self.lock:
+            self.trace_file.write(f'{timestamp:.6f} {direction} {data.hex()}\n')
+
+    def write(self, data):
+        'Record and send data.'
+        self._record('w', data)
+        return self.transport.write(data)
+
+    def read(self, size=1):
+        'Receive and record data.'
+        data = self.transport.read(size)
+        self._record('r', data)
+        return data
+
+    @property
+    def in_waiting(self):
+        'Number of bytes waiting to be read.'
+        return self.transport.in_waiting
+
+    def close(self):
+        'Close the transport and the trace file.'
+        self.transport.close()
+        self.trace_file.close()
+
+
+class ReplaySerial():
+    '''Serial transport that plays back a recorded trace.
+
+    Received data is released relative to the write that preceded it in the
+    recording, so replayed timing follows the host rather than the wall clock.
+    '''
+
+    def __init__(self, path, speed=1.0, timeout=0.1):
+        self.speed = speed
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.expected = []
+        self.reads = []
+        anchor = 0
+        for timestamp, direction, data in load_trace(path):
+            if direction == 'w':
+                self.expected.append(data)
+                anchor = timestamp
+            else:
+                self.reads.append((len(self.expected), timestamp - anchor, data))
+        self.anchors = [monotonic()]
+        self.ready = b''
+        self.mismatches = []
+
+    def write(self, data):
+        'Check data against the recorded write and advance the replay.'
+        with self.condition:
+            index = len(self.anchors) - 1
+            expected = self.expected[index] if index < len(self.expected) else None
+            if data != expected:
+                self.mismatches.append((expected, data))
+            self.anchors.append(monotonic())
+            self.condition.notify_all()
+        return len(data)
+
+    def _release(self):
+        'Move due recorded reads to the ready buffer. Return the next due time.'
+        while self.reads:
+            index, delay, data = self.reads[0]
+            if index >= len(self.anchors):
+                return None
+            due = self.anchors[index] + delay / self.speed
+            if due > monotonic():
+                return due
+            self.ready += data
+            self.reads.pop(0)
+        return None
+
+    def read(self, size=1):
+        'Return up to size replayed bytes, waiting up to the timeout.'
+        deadline = monotonic() + self.timeout
+        with self.condition:
+            while True:
+                due = self._release()
+                now = monotonic()
+                if self.ready or now >= deadline:
+                    break
+                self.condition.wait(min(due or deadline, deadline) - now)
+            data, self.ready = self.ready[:size], self.ready[size:]
+        return data
+
+    @property
+    def in_waiting(self):
+        'Number of replayed bytes ready to be read.'
+        with self.condition:
+            self._release()
+            return len(self.ready)
+
+    def close(self):
+        'Nothing to release.'
+
+
+def summarize(path):
+    'Return (command, round trip seconds) for each tagged command in a trace.'
+    sent = {}
+    completed = []
+    buffer = b''
+    for timestamp, direction, data in load_trace(path):
+        if direction == 'w':
+            command, _, tag = data.strip().decode().rpartition(' Q')
+            sent[tag] = (command, timestamp)
+            continue
+        *lines, buffer = (buffer + data).split(b'\r\n')
+        for line in lines:
+            words = line.decode(errors='replace').split(' ')
+            if words[0] in ['R02', 'R03'] and words[-1][1:] in sent:
+                command, start = sent.pop(words[-1][1:])
+                completed.append((command, timestamp - start))
+    return completed
+
+
+if __name__ == '__main__':
+    for COMMAND, DURATION in summarize(sys.argv[1]):
+        print(f'{DURATION * 1000:>9.1f} ms  {COMMAND}')
@@ -4,29 +4,48 @@
 
 import os
 import json
-from time import sleep
 
 DEFAULTS = {
     'input_coverage_threshold': 5,
+    'capture_quality_check': False,
+    'capture_sharpness_threshold': 10,
+    'capture_retry_count': 2,
     'disparity_coverage_threshold': 2,
     'pixel_value_threshold': 1,
     'camera_port': 0,
+    'dual_camera': False,
+    'right_camera_port': 1,
     'reverse_image_order': False,
     'repeat_capture_delay_s': 3,
     'read_position_delay': 0.5,
+    'read_position_interval': 0.05,
     'frame_discard_count': 10,
+    'persistent_camera': False,
+    'adaptive_frame_discard': False,
+    'frame_settle_tolerance': 1,
+    'sweep_capture': False,
+    'sweep_tolerance_mm': 0.5,
     'stereo_y': 10,
     'set_offset_mm': 50,
     'assume_target_reached': False,
     'number_of_stereo_sets': 2,
     'force_sets': False,
+    'analytical_calibration': False,
+    'early_calibration_stop': False,
+    'minimum_stereo_sets': 2,
+    'fit_convergence_tolerance': 1,
+    'pipeline_calculations': False,
     'movement_speed_percent': 100,
     'blur': 0,
     'use_plant_color_mask': True,
+    'luma_only': False,
     'soil_height_point_radius': 0,
     'edit_fbos_config': False,
     'save_point': True,
+    'results_outbox': False,
+    'results_outbox_file': 'results_outbox.json',
     'capture_count_at_each_location': 1,
+    'fuse_captures': False,
     'image_blend_percent': 50,
     'wide_sigma_threshold': 10,
     'selection_width': 3,
@@ -34,16 +53,28 @@ DEFAULTS = {
     'angle_percent_threshold': 3,
     'delta_value_threshold': 0.25,
     'use_flow': False,
+    'disparity_engine': 'bm',
+    'disparity_workers': 1,
+    'opencv_threads': -1,
+    'disparity_fusion': 'fill',
+    'auto_search_range': False,
+    'search_range_margin': 4,
+    'search_range_edge_percent': 1,
+    'search_range_history_file': 'search_range_history.json',
     'adjust_calibration_parameters': False,
     'image_annotate_soil_z': False,
     'capture_only': False,
     'save_reports': False,
     'exit_on_error': True,
+    'log_batch_size': 1,
+    'log_batch_interval': 1,
     'use_serial': False,
     'serial_port': '/dev/ttyUSB0',
     'serial_baud_rate': 115200,
     'serial_reset_position': False,
     'serial_z_negative': True,
+    'serial_param_cache': '',
+    'serial_trace': '',
     'use_lights': False,
     'pre_rotation_angle': 0,
     'time': False,
@@ -51,11 +82,24 @@ DEFAULTS = {
 
 STRINGS = [
     'serial_port',
+    'serial_param_cache',
+    'serial_trace',
+    'results_outbox_file',
+    'search_range_history_file',
+    'disparity_engine',
+    'disparity_fusion',
 ]
 FLOATS = [
     'disparity_percent_threshold',
     'delta_value_threshold',
     'read_position_delay',
+    'read_position_interval',
+    'frame_settle_tolerance',
+    'sweep_tolerance_mm',
+    'capture_sharpness_threshold',
+    'fit_convergence_tolerance',
+    'log_batch_interval',
+    'search_range_edge_percent',
 ]
 
 with open('manifest.json', 'r') as manifest_file:
@@ -133,9 +177,9 @@ class Settings():
         firmware_params = device.get_bot_state().get('mcu_params', {})
         self.settings['negative_z'] = firmware_params.get(
             'movement_home_up_z', 1)
-        device.read_status()
-        sleep(self.settings['read_position_delay'])
-        loc = device.get_current_position()
+        loc = device.wait_for_position(
+            timeout=self.settings['read_position_delay'],
+            interval=self.settings['read_position_interval'])
         position = {axis: float(loc.get(axis)) for axis in ['x', 'y', 'z']
                     if loc is not None and loc.get(axis) is not None}
         self.settings['initial_position'] = position
@@ -162,6 +206,19 @@ class Settings():
             'extras': img_verbosity > 6,
         }
 
+    def luma_only(self):
+        'Check if captures can be reduced to luma without losing any output.'
+        color_required = (self.settings['use_plant_color_mask']
+                          or self.images['depth_color']
+                          or self.images['collage']
+                          or self.images['extras'])
+        return bool(self.settings['luma_only']) and not color_required
+
+    def analytical_calibration(self):
+        'Check if the calibration factor can be derived from a single set.'
+        pixel_scale_known = self.settings['millimeters_per_pixel'] > 0
+        return bool(self.settings['analytical_calibration']) and pixel_scale_known
+
     def update(self, key, value):
         'Update a setting value.'
         self.settings[key] = value
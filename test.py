@@ -2,14 +2,34 @@
 
 'Run tests.'
 
+import json
 import os
 import sys
-from time import time
+from time import time, sleep
 TIMES = {'start': time()}
 if TIMES:
+    import numpy as np
+    import cv2 as cv
     from measure_height import MeasureSoilHeight
-    from tests.mocks import MockDevice, MockTools, MockCV
+    from core import Core
+    from calculate_multiple import CalculateMultiple
+    from calculate import Calculate, bounded_map
+    from tests.mocks import MockDevice, MockTools, MockCV, VirtualClock
     from tests.runner import TestRunner, print_title
+    from position import wait_for_position
+    from camera import capture_concurrently
+    from tests.generate_images import ImageGenerator
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from settings import Settings
+    from serial_device import SerialDevice, FirmwareState, MAX_IN_FLIGHT
+    from serial_trace import ReplaySerial, summarize
+    from results import Outbox
+    from log import Log
+    from tests.firmware_simulator import FirmwareSimulator
+    from disparity import ENGINES, DisparityEngine, MedianFusion
+    from disparity import get_engine, set_thread_policy
+    from process_image import ProcessImage
 TIMES['imports_done'] = time()
 
 
@@ -45,20 +65,30 @@ def _point(soil_z):
     }
 
 
-def test_calibration():
-    'Test MeasureSoilHeight calibration.'
-    print_title('MeasureSoilHeight calibration', char='|')
+def _mock_measure_soil(device=None, cv=None, tools=None, environ=None,
+                       **settings):
+    'Return a MeasureSoilHeight with mock devices and the provided settings.'
     os.environ.clear()
-    os.environ['measure_soil_height_measured_distance'] = '100'
-    os.environ['measure_soil_height_repeat_capture_delay_s'] = '0'
-    os.environ['measure_soil_height_verbose'] = '5'
+    settings = {'measured_distance': 100, 'repeat_capture_delay_s': 0, **settings}
+    for key, value in settings.items():
+        os.environ[f'measure_soil_height_{key}'] = str(value)
+    os.environ.update(environ or {})
     measure_soil = MeasureSoilHeight()
-    measure_soil.device = MockDevice()
+    measure_soil.device = device or MockDevice()
     measure_soil.core.tools.device = MockDevice()
     measure_soil.core.settings.init_device_settings()
     measure_soil.log.device = MockDevice()
-    measure_soil.core.results.tools = MockTools()
-    measure_soil.cv = MockCV()
+    measure_soil.core.results.tools = tools or MockTools()
+    measure_soil.cv = cv or MockCV()
+    return measure_soil
+
+
+def test_calibration(pipelined=False):
+    'Test MeasureSoilHeight calibration.'
+    pipeline_title = ' (pipelined)' if pipelined else ''
+    print_title(f'MeasureSoilHeight calibration{pipeline_title}', char='|')
+    measure_soil = _mock_measure_soil(
+        verbose=5, pipeline_calculations=int(pipelined))
     measure_soil.capture_images()
     measure_soil.calculate()
     coords = measure_soil.device.position_history
@@ -81,6 +111,8 @@ def test_calibration():
         ['calibration_measured_at_z', 0.0],
         ['calibration_maximum', 164],
     ], envs
+    batches = measure_soil.core.results.tools.config_batches
+    assert batches == [], batches
     posts = measure_soil.core.results.tools.post_history
     assert posts == [['points', _point(-99)]], posts
     pins = measure_soil.device.pin_history
@@ -89,23 +121,130 @@ def test_calibration():
     assert count == 44, count
 
 
+def test_analytical_calibration():
+    'Test MeasureSoilHeight single set analytical calibration.'
+    print_title('MeasureSoilHeight analytical calibration', char='|')
+    measure_soil = _mock_measure_soil(
+        verbose=5, analytical_calibration=1,
+        environ={'CAMERA_CALIBRATION_coord_scale': '0.5'})
+    measure_soil.capture_images()
+    measure_soil.calculate()
+    coords = measure_soil.device.position_history
+    assert coords == [
+        {'x': 0, 'y': 0, 'z': 0},
+        {'x': 0, 'y': 10, 'z': 0},
+        {'x': 0, 'y': 0, 'z': 0},
+    ], coords
+    envs = measure_soil.core.results.tools.config_history
+    assert ['calibration_factor', 0.3125] in envs, envs
+    posts = measure_soil.core.results.tools.post_history
+    assert posts == [['points', _point(-100)]], posts
+
+
+def test_pipeline_remeasure():
+    'Test MeasureSoilHeight pipelined calibration followed by a measurement.'
+    print_title('MeasureSoilHeight pipelined remeasure', char='|')
+    measure_soil = _mock_measure_soil(verbose=5, pipeline_calculations=1)
+    measure_soil.capture_images()
+    measure_soil.calculate()
+    calibration = measure_soil.calculations
+    assert measure_soil.pipeline is None
+    measure_soil.images = []
+    measure_soil.capture_images()
+    measure_soil.calculate()
+    assert measure_soil.calculations is not calibration
+    results = measure_soil.calculations.set_results
+    assert len(results) == 1, results
+    posts = measure_soil.core.results.tools.post_history
+    assert len(posts) == 2, posts
+
+
+def test_results_outbox():
+    'Test MeasureSoilHeight calibration with queued result writes.'
+    print_title('MeasureSoilHeight results outbox', char='|')
+    with tempfile.TemporaryDirectory() as directory:
+        outbox_file = os.path.join(directory, 'results_outbox.json')
+        tools = MockTools(latency=1)
+        measure_soil = _mock_measure_soil(
+            tools=tools, verbose=5, results_outbox=1,
+            results_outbox_file=outbox_file)
+        measure_soil.capture_images()
+        start = time()
+        measure_soil.calculate()
+        duration = time() - start
+        assert duration < 1, duration
+        measure_soil.results.flush()
+        assert tools.config_history == [
+            ['disparity_search_depth', 2],
+            ['calibration_factor', 0.3147],
+            ['calibration_disparity_offset', 159.78125],
+            ['calibration_image_width', 100],
+            ['calibration_image_height', 100],
+            ['calibration_measured_at_z', 0.0],
+            ['calibration_maximum', 164],
+        ], tools.config_history
+        assert len(tools.config_batches) <= 2, tools.config_batches
+        assert not os.path.exists(outbox_file)
+
+        def _fail(_items):
+            raise ConnectionError('offline')
+        item = {'kind': 'post', 'endpoint': 'points', 'payload': _point(-100)}
+        outbox = Outbox(_fail, outbox_file, measure_soil.log)
+        outbox.put(item)
+        assert not outbox.flush()
+        sent = []
+        outbox = Outbox(sent.extend, outbox_file, measure_soil.log)
+        assert outbox.flush()
+        assert sent == [item], sent
+        assert not os.path.exists(outbox_file)
+        with open(outbox_file, 'w') as corrupt_file:
+            corrupt_file.write('[{"kind": "po')
+        outbox = Outbox(sent.extend, outbox_file, measure_soil.log)
+        assert outbox.pending == [], outbox.pending
+        outbox.put(item)
+        assert outbox.flush(timeout=1)
+        assert sent == [item, item], sent
+
+
+def test_log_batching():
+    'Test batched debug logs.'
+    print_title('Log batching', char='|')
+    settings = {'log_verbosity': 3, 'log_batch_size': 3,
+                'log_batch_interval': 60, 'time': 1, 'exit_on_error': 0}
+    log = Log(settings, MockDevice())
+    for i in range(4):
+        log.debug(f'message {i}')
+    assert len(log.device.log_history) == 1, log.device.log_history
+    log.log('Soil height saved: -100', 'success', ['toast'])
+    calls = [(call['message'].count('message'), call['kwargs']['message_type'])
+             for call in log.device.log_history]
+    assert calls == [(3, 'debug'), (1, 'debug'), (0, 'success')], calls
+    log.close()
+    last = log.device.log_history[-1]['message']
+    assert last.endswith('Log batching saved 2 device calls.'), last
+
+    log.settings['log_batch_interval'] = 0.01
+    log.debug('quiet tail')
+    for _ in range(100):
+        if log.device.log_history[-1]['message'].endswith('quiet tail'):
+            break
+        sleep(0.01)
+    last = log.device.log_history[-1]['message']
+    assert last.endswith('quiet tail'), last
+    assert log.batch == [], log.batch
+
+    def _unused():
+        raise AssertionError('Discarded message formatted.')
+    log.settings['log_verbosity'] = 0
+    log.debug(_unused)
+
+
 def test_measure_soil_height():
     'Test MeasureSoilHeight.'
     print_title('MeasureSoilHeight', char='|')
-    os.environ.clear()
-    os.environ['measure_soil_height_measured_distance'] = '100'
-    os.environ['measure_soil_height_calibration_factor'] = '1'
-    os.environ['measure_soil_height_calibration_disparity_offset'] = '160'
-    os.environ['measure_soil_height_repeat_capture_delay_s'] = '0'
-    os.environ['measure_soil_height_verbose'] = '5'
-    os.environ['measure_soil_height_log_verbosity'] = '2'
-    measure_soil = MeasureSoilHeight()
-    measure_soil.device = MockDevice()
-    measure_soil.core.tools.device = MockDevice()
-    measure_soil.core.settings.init_device_settings()
-    measure_soil.log.device = MockDevice()
-    measure_soil.core.results.tools = MockTools()
-    measure_soil.cv = MockCV()
+    measure_soil = _mock_measure_soil(
+        calibration_factor=1, calibration_disparity_offset=160, verbose=5,
+        log_verbosity=2)
     measure_soil.capture_images()
     measure_soil.calculate()
     coords = measure_soil.device.position_history
@@ -138,6 +277,676 @@ def test_measure_soil_height():
     assert params == {'width': 640, 'height': 480}, params
 
 
+def test_capture_timing():
+    'Report simulated MeasureSoilHeight calibration timing.'
+    print_title('MeasureSoilHeight capture timing', char='|')
+    with VirtualClock() as clock:
+        speeds = {'x': 100, 'y': 100, 'z': 20}
+        measure_soil = _mock_measure_soil(
+            device=MockDevice(clock=clock, speeds=speeds, settle_time=0.5),
+            cv=MockCV(clock=clock, grab_latency=1 / 30),
+            repeat_capture_delay_s=3, verbose=5)
+        start = clock.time(), time()
+        measure_soil.capture_images()
+        captured = clock.time()
+        measure_soil.calculate()
+        done = clock.time(), time()
+    simulated = {'capture': captured - start[0], 'calculate': done[0] - captured}
+    print(f"simulated capture: {simulated['capture']:.2f}s, "
+          f"calculate: {simulated['calculate']:.2f}s "
+          f'(ran in {done[1] - start[1]:.2f}s)')
+    settings = measure_soil.settings
+    moves = 2 * (10 / 100 + 50 / 20 + 2 * 0.5)
+    per_capture = (settings['repeat_capture_delay_s']
+                   + settings['frame_discard_count'] * (1 / 30 + 0.1) + 1 / 30)
+    assert simulated['capture'] >= moves + 4 * per_capture, simulated
+    assert done[1] - start[1] < simulated['capture'], simulated
+
+
+def test_persistent_camera():
+    'Test MeasureSoilHeight with a persistent camera session.'
+    print_title('MeasureSoilHeight persistent camera', char='|')
+    measure_soil = _mock_measure_soil(
+        persistent_camera=1, capture_count_at_each_location=2)
+    measure_soil.capture_images()
+    ports = measure_soil.cv.port_history
+    assert ports == [0], ports
+    releases = measure_soil.cv.release_count
+    assert releases == 1, releases
+    warm_up = measure_soil.cameras[0].warm_up_id
+    assert warm_up == 10, warm_up
+    captures = [len(images[stereo_id]) for images in measure_soil.images
+                for stereo_id in ['left', 'right']]
+    assert captures == [2, 2, 2, 2], captures
+    coords = measure_soil.device.position_history
+    assert coords == [
+        {'x': 0, 'y': 0, 'z': 0},
+        {'x': 0, 'y': 10, 'z': 0},
+        {'x': 0, 'y': 10, 'z': -50},
+        {'x': 0, 'y': 0, 'z': -50},
+        {'x': 0, 'y': 0, 'z': 0},
+    ], coords
+
+
+def test_adaptive_frame_discard():
+    'Test MeasureSoilHeight adaptive frame discard.'
+    print_title('MeasureSoilHeight adaptive frame discard', char='|')
+    settings = {'adaptive_frame_discard': 1, 'frame_settle_tolerance': 25,
+                'log_verbosity': 3}
+    measure_soil = _mock_measure_soil(**settings)
+    measure_soil.capture_images()
+    count = measure_soil.cv.capture_count
+    assert count == 12, count
+    discards = [log['message'] for log in measure_soil.log.sent
+                if 'Discarded' in log['message']]
+    assert len(discards) == 4, discards
+    assert all('Discarded 2 of 10 frames' in log for log in discards), discards
+
+    measure_soil = _mock_measure_soil(**settings, persistent_camera=1)
+    measure_soil.capture_images()
+    discards = [log['message'] for log in measure_soil.log.sent
+                if 'Discarded' in log['message']]
+    assert len(discards) == 1, discards
+
+    measure_soil = _mock_measure_soil(cv=MockCV(dark_before=3), **settings)
+    measure_soil.capture_images()
+    discards = [log['message'] for log in measure_soil.log.sent
+                if 'Discarded' in log['message']]
+    assert 'Discarded 5 of 10 frames' in discards[0], discards
+
+
+def test_wait_for_position():
+    'Test position settle.'
+    print_title('wait_for_position', char='|')
+    stale = {'x': 0, 'y': 0, 'z': 0}
+    target = {'x': 0, 'y': 10, 'z': 0}
+    reports = [stale, stale, {'x': 0, 'y': 5, 'z': 0}, target, target]
+    polled = iter(reports)
+    position = wait_for_position(lambda: next(polled), target, interval=0)
+    assert position == target, position
+    remaining = len(list(polled))
+    assert remaining == 1, remaining
+    polled = iter(reports + [target])
+    position = wait_for_position(lambda: next(polled), interval=0)
+    assert position == target, position
+    polls = []
+    position = wait_for_position(
+        lambda: polls.append(stale) or stale, target, timeout=0.05, interval=0.01)
+    assert position == stale, position
+    assert len(polls) > 3, polls
+
+
+def test_capture_location():
+    'Test MeasureSoilHeight capture location waits.'
+    print_title('MeasureSoilHeight capture location', char='|')
+    for assume in ['0', '1']:
+        measure_soil = _mock_measure_soil(assume_target_reached=assume)
+        measure_soil.settings['initial_position'] = {}
+        waits = []
+        wait = measure_soil.device.wait_for_position
+        measure_soil.device.wait_for_position = lambda expected, **kwargs: (
+            waits.append(expected) or wait(expected, **kwargs))
+        measure_soil.capture_images()
+        assert waits == ([] if assume == '1' else [None] * 4), waits
+
+
+def test_firmware_state():
+    'Test FirmwareState waits for a status newer than the last command.'
+    print_title('FirmwareState', char='|')
+    state = FirmwareState()
+    state.update(b'R00 Q0')
+    assert state.wait_for_status(['R00'], 0.01)
+    since = state.reports
+    assert not state.wait_for_status(['R00'], 0.01, since)
+    state.update(b'R82 X1 Y2 Z3 Q0')
+    assert not state.wait_for_status(['R00'], 0.01, since)
+    state.update(b'R00 Q0')
+    assert state.wait_for_status(['R00'], 0.01, since)
+
+
+def test_serial_device():
+    'Test SerialDevice with simulated firmware.'
+    print_title('SerialDevice', char='|')
+    options = {'latency': 0.002, 'jitter': 0.002, 'noise': 0.1,
+               'time_scale': 0.1, 'report_interval': 0.02,
+               'startup_delay': 0.05}
+    with tempfile.TemporaryDirectory() as directory, \
+            FirmwareSimulator(**options) as firmware:
+        os.environ.clear()
+        os.environ['measure_soil_height_serial_port'] = firmware.port
+        os.environ['measure_soil_height_serial_param_cache'] = os.path.join(
+            directory, 'serial_param_cache.json')
+        device = SerialDevice(Settings().settings)
+        assert device.speed == {'x': 800, 'y': 800, 'z': 1000}, device.speed
+        assert firmware.params[53] == 1 and firmware.params[2] == 1
+        device.move_relative(10, 20, -5, 100)
+        expected = {'x': 10, 'y': 20, 'z': -5}
+        assert firmware.position == expected, firmware.position
+        assert device.get_current_position() == expected
+        pin = device.write_pin(7, 1, 0)
+        assert pin == [], pin
+        assert firmware.received[-1].startswith('F41 P7 V1 M0'), firmware.received
+        stale = {'x': 999, 'y': 0, 'z': 0}
+        device.state.update(b'R82 X999 Y0 Z0 Q0')
+        move = device.send_async('G00 X10 Y20 Z0 A800 B800 C1000')
+        assert device.state.get_position() != stale
+        device.result(move)
+        assert device.get_current_position() == {'x': 10, 'y': 20, 'z': 0}
+        device.wait_for_idle()
+        assert device.state.status_report > device.sent_report
+        device.close()
+        sent = len(firmware.received)
+        firmware.write('R99 ARDUINO STARTUP COMPLETE')
+        device = SerialDevice(Settings().settings)
+        assert device.speed == {'x': 800, 'y': 800, 'z': 1000}, device.speed
+        commands = [c.split(' Q')[0] for c in firmware.received[sent:]]
+        assert commands == ['F83', 'F21 P71', 'F22 P2 V1'], commands
+        device.close()
+        firmware.params.update({71: 700, 73: 500})
+        sent = len(firmware.received)
+        firmware.write('R99 ARDUINO STARTUP COMPLETE')
+        device = SerialDevice(Settings().settings)
+        assert device.speed == {'x': 700, 'y': 800, 'z': 500}, device.speed
+        commands = [c.split(' Q')[0] for c in firmware.received[sent:]]
+        assert commands == ['F83', 'F21 P71', 'F21 P72', 'F21 P73',
+                            'F21 P53', 'F22 P2 V1'], commands
+        device.close()
+        cache_path = os.environ['measure_soil_height_serial_param_cache']
+        with open(cache_path, 'w') as cache_file:
+            cache_file.write('{"' + firmware.port)
+        firmware.write('R99 ARDUINO STARTUP COMPLETE')
+        device = SerialDevice(Settings().settings)
+        assert device.speed == {'x': 700, 'y': 800, 'z': 500}, device.speed
+        device.close()
+        with open(cache_path, 'r') as cache_file:
+            cached = json.load(cache_file)[firmware.port]
+        assert cached['params']['73'] == 500, cached
+
+
+def test_serial_queue():
+    'Test SerialDevice correlates tagged responses and caps commands in flight.'
+    print_title('SerialDevice queue', char='|')
+    options = {'latency': 0.01, 'time_scale': 0.1, 'report_interval': 0.02,
+               'startup_delay': 0.05}
+    with FirmwareSimulator(**options) as firmware:
+        os.environ.clear()
+        os.environ['measure_soil_height_serial_port'] = firmware.port
+        device = SerialDevice(Settings().settings)
+        firmware.params.update({72: 801, 73: 1001, 100: 5})
+        in_flight = []
+        write = device.serial.write
+
+        def _write(data):
+            in_flight.append(len(device.requests))
+            return write(data)
+        device.serial.write = _write
+        firmware.write('R21 P100 V7 Q99')
+        params = [71, 72, 73, 100] * 2
+        requests = [device.send_async(f'F21 P{param}') for param in params]
+        values = [device.result(request) for request in requests]
+        assert values == [[b'P71', b'V800'], [b'P72', b'V801'],
+                          [b'P73', b'V1001'], [b'P100', b'V5']] * 2, values
+        assert max(in_flight) == MAX_IN_FLIGHT, in_flight
+        assert not device.requests, device.requests
+        device.close()
+
+
+def test_serial_trace():
+    'Test serial traffic record and replay.'
+    print_title('serial trace', char='|')
+    options = {'latency': 0.005, 'time_scale': 0.2, 'report_interval': 0.02,
+               'startup_delay': 0.05}
+    with tempfile.TemporaryDirectory() as directory:
+        trace = os.path.join(directory, 'serial_trace.txt')
+        os.environ.clear()
+        os.environ['measure_soil_height_serial_trace'] = trace
+        with FirmwareSimulator(**options) as firmware:
+            os.environ['measure_soil_height_serial_port'] = firmware.port
+            start = time()
+            device = SerialDevice(Settings().settings)
+            device.move_relative(0, 50, 0, 100)
+            device.close()
+            recorded = time() - start
+        del os.environ['measure_soil_height_serial_trace']
+        commands = [command for command, _duration in summarize(trace)]
+        assert commands[-1] == 'G00 X0.0 Y50.0 Z0.0 A800.0 B800.0 C1000.0', commands
+        replay = ReplaySerial(trace, speed=4)
+        start = time()
+        device = SerialDevice(Settings().settings, transport=replay)
+        device.move_relative(0, 50, 0, 100)
+        assert device.get_current_position()['y'] == 50
+        device.close()
+        replayed = time() - start
+        assert replay.mismatches == [], replay.mismatches
+        assert replayed < recorded, (replayed, recorded)
+
+
+def test_sweep_capture():
+    'Test MeasureSoilHeight sweep capture.'
+    print_title('MeasureSoilHeight sweep capture', char='|')
+    measure_soil = _mock_measure_soil(sweep_capture=1, log_verbosity=3)
+    measure_soil.capture_images()
+    locations = [[images[stereo_id][0]['location']
+                  for stereo_id in ['left', 'right']]
+                 for images in measure_soil.images]
+    assert locations == [
+        [{'x': 0, 'y': 0, 'z': 0}, {'x': 0, 'y': 10, 'z': 0}],
+        [{'x': 0, 'y': 0, 'z': -50}, {'x': 0, 'y': 10, 'z': -50}],
+    ], locations
+    messages = [log['message'] for log in measure_soil.log.sent]
+    selected = [message for message in messages if 'Image selected' in message]
+    assert len(selected) == 2, messages
+    fallbacks = [message for message in messages if 'Capturing after move' in message]
+    assert fallbacks == [], fallbacks
+    ports = measure_soil.cv.port_history
+    assert ports == [0], ports
+    coords = measure_soil.device.position_history
+    assert coords[-1] == {'x': 0, 'y': 0, 'z': 0}, coords
+
+
+def test_dual_camera():
+    'Test MeasureSoilHeight dual camera capture.'
+    print_title('MeasureSoilHeight dual camera', char='|')
+    settings = {'frame_discard_count': 0, 'dual_camera': 1}
+    measure_soil = _mock_measure_soil(**settings)
+    measure_soil.capture_images()
+    coords = measure_soil.device.position_history
+    assert coords == [
+        {'x': 0, 'y': 0, 'z': 0},
+        {'x': 0, 'y': 0, 'z': -50},
+        {'x': 0, 'y': 0, 'z': 0},
+    ], coords
+    ports = sorted(measure_soil.cv.port_history)
+    assert ports == [0, 0, 1, 1], ports
+    count = measure_soil.cv.capture_count
+    assert count == 4, count
+    captures = [len(images[stereo_id]) for images in measure_soil.images
+                for stereo_id in ['left', 'right']]
+    assert captures == [1, 1, 1, 1], captures
+
+    measure_soil = _mock_measure_soil(**settings, persistent_camera=1)
+    measure_soil.capture_images()
+    ports = sorted(measure_soil.cv.port_history)
+    assert ports == [0, 1], ports
+    releases = measure_soil.cv.release_count
+    assert releases == 2, releases
+    captures = [len(images[stereo_id]) for images in measure_soil.images
+                for stereo_id in ['left', 'right']]
+    assert captures == [1, 1, 1, 1], captures
+
+    mock_cv = MockCV()
+
+    def _open_device(port):
+        if port == 1:
+            raise RuntimeError('Camera unavailable.')
+        return mock_cv.VideoCapture(port)
+
+    try:
+        capture_concurrently(_open_device, [0, 1], timeout=1)
+    except RuntimeError as error:
+        failed = str(error)
+    else:
+        failed = None
+    assert failed == 'Camera unavailable.', failed
+    assert mock_cv.capture_count == 0, mock_cv.capture_count
+    assert mock_cv.release_count == 1, mock_cv.release_count
+
+
+def test_capture_quality_check():
+    'Test MeasureSoilHeight capture quality check.'
+    print_title('MeasureSoilHeight capture quality check', char='|')
+    settings = {'frame_discard_count': 0, 'capture_quality_check': 1}
+    measure_soil = _mock_measure_soil(**settings, input_coverage_threshold=50)
+    try:
+        measure_soil.capture_images()
+    except SystemExit:
+        aborted = True
+    else:
+        aborted = False
+    assert aborted
+    errors = measure_soil.log.errors
+    assert errors == ['Not enough detail. Check recent images.'], errors
+    coords = measure_soil.device.position_history
+    assert coords == [{'x': 0, 'y': 0, 'z': 0}] * 2, coords
+    count = measure_soil.cv.capture_count
+    assert count == 3, count
+
+    measure_soil = _mock_measure_soil(
+        cv=MockCV(dark_after=1), **settings, input_coverage_threshold=5,
+        use_lights=1)
+    try:
+        measure_soil.capture_images()
+    except SystemExit:
+        aborted = True
+    else:
+        aborted = False
+    assert aborted
+    coords = measure_soil.device.position_history
+    assert coords == [
+        {'x': 0, 'y': 0, 'z': 0},
+        {'x': 0, 'y': 10, 'z': 0},
+        {'x': 0, 'y': 0, 'z': 0},
+    ], coords
+    pins = [pin['pin_value'] for pin in measure_soil.device.pin_history
+            if pin['pin_number'] == 7]
+    assert pins == [1, 0], pins
+
+
+def _noisy_captures(count=3):
+    generator = ImageGenerator()
+    generator.options = {**generator.options, 'form': 'soil_surface', 'factor': 1}
+    random = np.random.default_rng(0)
+    image_set = {}
+    for stereo_id, filename in generator.generate().items():
+        image = cv.imread(filename)
+        image_set[stereo_id] = []
+        for _ in range(count):
+            noise = random.normal(0, 20, image.shape)
+            noisy = np.clip(image + noise, 0, 255).astype(np.uint8)
+            image_set[stereo_id].append({
+                'data': noisy, 'name': filename, 'tag': stereo_id,
+                'location': {'x': 0, 'y': 0, 'z': 0}})
+    return image_set
+
+
+def _calculation_core(title, **settings):
+    core = Core(title=title, quiet=True)
+    core.settings.update('verbose', 0)
+    core.settings.update('save_point', False)
+    core.settings.update('measured_distance', 250)
+    core.settings.update('calibration_factor', 0.6173)
+    core.settings.update('calibration_disparity_offset', 158.0)
+    for key, value in settings.items():
+        core.settings.update(key, value)
+    return core
+
+
+def test_fuse_captures():
+    'Test CalculateMultiple with fused captures.'
+    print_title('CalculateMultiple fused captures', char='|')
+    os.environ.clear()
+    matches = []
+    compute = DisparityEngine.compute
+    DisparityEngine.compute = lambda engine, left, right: (
+        matches.append(engine.name) or compute(engine, left, right))
+    try:
+        for fuse in [False, True]:
+            matches.clear()
+            core = _calculation_core('fused', fuse_captures=fuse)
+            calcs = CalculateMultiple(core, [_noisy_captures()])
+            calcs.calculate_multiple()
+            assert matches == ['bm'] * (1 if fuse else 9), matches
+    finally:
+        DisparityEngine.compute = compute
+    soil_z = calcs.set_results[0]['values']['calculated_soil_z']
+    assert soil_z == -250, soil_z
+
+
+def _pinhole_sets(z_values, distance=250, mm_per_pixel=0.5, baseline=10):
+    generator = ImageGenerator()
+    generator.options = {**generator.options, 'form': 'soil_surface', 'factor': 1}
+    texture = cv.imread(generator.generate()['right'])
+    height, width = texture.shape[:2]
+    focal_length = distance / mm_per_pixel
+    image_sets = []
+    for z_value in z_values:
+        shift = focal_length * baseline / (distance + z_value)
+        matrix = np.float32([[1, 0, shift], [0, 1, 0]])
+        left = cv.warpAffine(texture, matrix, (width, height),
+                             borderMode=cv.BORDER_REFLECT)
+        location = {'x': 0, 'y': 0, 'z': z_value}
+        image_sets.append({
+            stereo_id: [{'data': data, 'name': stereo_id, 'tag': stereo_id,
+                         'location': location}]
+            for stereo_id, data in [('left', left), ('right', texture)]})
+    return image_sets
+
+
+def test_analytical_factor():
+    'Test analytical calibration factor against multi-set calibration.'
+    print_title('CalculateMultiple analytical calibration', char='|')
+    os.environ.clear()
+    os.environ['CAMERA_CALIBRATION_coord_scale'] = '0.5'
+    factors = {}
+    for analytical in [False, True]:
+        core = _calculation_core(
+            'analytical', calibration_factor=0, calibration_disparity_offset=0,
+            analytical_calibration=int(analytical))
+        z_values = [0, -7] if analytical else [0, -50, -7]
+        calcs = CalculateMultiple(core, _pinhole_sets(z_values))
+        calcs.calculate_multiple()
+        factors[analytical] = core.settings.settings['calibration_factor']
+        soil_z = calcs.set_results[-1]['values']['calculated_soil_z']
+        assert abs(soil_z + 250) <= 1, soil_z
+    assert factors[True] == 0.7812, factors
+    # The multi-set fit is the secant between 250 and 200 mm.
+    secant = factors[True] * 200 / 250
+    assert abs(factors[False] - secant) / secant < 0.02, factors
+
+
+def test_disparity_engines():
+    'Test disparity engines.'
+    print_title('Disparity engines', char='|')
+    image_set = _pinhole_sets([0])[0]
+    left, right = [cv.cvtColor(image_set[stereo_id][0]['data'], cv.COLOR_BGR2GRAY)
+                   for stereo_id in ['left', 'right']]
+    for name in ENGINES:
+        engine = get_engine(name, 48, 15)
+        assert get_engine(name, 48, 15) is engine, name
+        disparity, info = engine.compute(left, right)
+        assert disparity.dtype == np.int16, (name, disparity.dtype)
+        assert disparity.shape == left.shape, (name, disparity.shape)
+        assert info['engine'] == name and info['coverage'] > 50, info
+        if name != 'flow':
+            median = np.median(disparity[disparity > engine.invalid])
+            assert median == 320, (name, median)
+    texture = np.random.RandomState(0).randint(0, 255, (120, 160)).astype(np.uint8)
+    texture = cv.resize(texture, (320, 240), interpolation=cv.INTER_NEAREST)
+    left, right = texture[:, :280].copy(), texture[:, 40:].copy()
+    engine = get_engine('bm_half', 48, 15)
+    disparity, _info = engine.compute(left, right)
+    median = np.median(disparity[disparity > engine.invalid])
+    assert median == 40 * 16, median
+    os.environ.clear()
+    core = _calculation_core('sgbm', disparity_engine='sgbm_fast')
+    calcs = CalculateMultiple(core, [_noisy_captures(count=1)])
+    calcs.calculate_multiple()
+    soil_z = calcs.set_results[0]['values']['calculated_soil_z']
+    assert abs(soil_z + 250) <= 2, soil_z
+
+
+def test_preprocess_cache():
+    'Test ProcessImage preprocess memoization.'
+    print_title('ProcessImage preprocess cache', char='|')
+    os.environ.clear()
+    core = _calculation_core('preprocess')
+    data = _noisy_captures(count=1)['left'][0]['data']
+    image = ProcessImage(core, data, 10, {})
+    rotated = image.preprocess()
+    assert image.preprocess() is rotated
+    unrotated = image.preprocess(perform_rotation=False)
+    assert unrotated is not rotated
+    assert image.preprocess(perform_rotation=False) is unrotated
+    image.angle = 0
+    assert image.preprocess() is not rotated
+    core.settings.settings['blur'] = 5
+    assert image.preprocess(perform_rotation=False) is not unrotated
+    core.settings.settings['blur'] = 0
+    image.image = image.image[:50]
+    assert image.preprocess(perform_rotation=False).shape == (50, 1000)
+    cached = image.preprocess(perform_rotation=False)
+    image.image[:, :10] = 255
+    edited = image.preprocess(perform_rotation=False)
+    assert edited is not cached
+    assert (edited[:, :10] == 255).all()
+
+
+def test_disparity_workers():
+    'Test CalculateMultiple with parallel disparity workers.'
+    print_title('CalculateMultiple disparity workers', char='|')
+    os.environ.clear()
+    results = {}
+    for workers in [1, 4]:
+        core = _calculation_core('workers', disparity_workers=workers)
+        calcs = CalculateMultiple(core, [_noisy_captures()])
+        calculation = Calculate(core, calcs.image_sets[0])
+        calculation.check_images()
+        calculation.calculate_disparity()
+        results[workers] = calculation.images.output['disparity_from_stereo'].image
+    assert np.array_equal(results[1], results[4])
+    expected_threads = max(1, (os.cpu_count() or 1) // 4)
+    assert cv.getNumThreads() == expected_threads, cv.getNumThreads()
+    set_thread_policy(1)
+    submitted = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for i, value in enumerate(bounded_map(pool, submitted.append, range(9), 2)):
+            assert value is None and len(submitted) <= i + 2, (i, submitted)
+    assert submitted == list(range(9)), submitted
+
+
+def test_median_fusion():
+    'Test streaming median disparity fusion.'
+    print_title('Disparity median fusion', char='|')
+    random = np.random.default_rng(0)
+    maps = random.integers(-16, 400, (9, 20, 30)).astype(np.int16)
+    fusion = MedianFusion(threshold=1)
+    for disparity in maps:
+        fusion.add(disparity)
+    valid = np.where(maps >= 1, maps, np.nan)
+    expected = np.round(np.nanmedian(valid, axis=0)).astype(np.int16)
+    assert np.array_equal(fusion.result(), expected)
+    count = (maps >= 1).sum(axis=0)
+    assert np.array_equal(fusion.confidence(), (100 * count / 9).astype(np.uint8))
+    fusion = MedianFusion(threshold=1, buffer_size=3)
+    for _ in range(30):
+        fusion.add(np.full((4, 4), 100, np.int16))
+    fusion.add(np.full((4, 4), -16, np.int16))
+    assert max(len(level) for level in fusion.levels) < 3, fusion.levels
+    buffered = [values.dtype for level in fusion.levels for values in level]
+    assert all(dtype == np.int16 for dtype in buffered), buffered
+    assert (fusion.result() == 100).all()
+    assert (fusion.confidence() == 96).all()
+    os.environ.clear()
+    core = _calculation_core('median', disparity_fusion='median')
+    calcs = CalculateMultiple(core, [_noisy_captures()])
+    calcs.calculate_multiple()
+    soil_z = calcs.set_results[0]['values']['calculated_soil_z']
+    assert soil_z == -250, soil_z
+
+
+def test_auto_search_range():
+    'Test automatic disparity search range narrowing.'
+    print_title('CalculateMultiple auto search range', char='|')
+    os.environ.clear()
+    soil_z = {}
+    directory = tempfile.TemporaryDirectory()
+    for auto, offset in [(0, 320), (1, 320), (1, 160)]:
+        history_file = os.path.join(directory.name, f'history_{offset}.json')
+        core = _calculation_core(
+            'search_range', auto_search_range=auto, calibration_factor=0.7812,
+            calibration_disparity_offset=offset, calibration_maximum=offset + 10,
+            disparity_search_depth=3, log_verbosity=2,
+            search_range_history_file=history_file)
+        calcs = CalculateMultiple(core, _pinhole_sets([0, -7, -20]))
+        calculation = Calculate(core, _pinhole_sets([0])[0], calcs.disparity_history)
+        search_range = calculation._search_range(48)
+        assert search_range == ((0, 48) if not auto else (offset // 16 - 5, 16)), (
+            search_range)
+        calcs.calculate_multiple()
+        results = [result['values']['calculated_soil_z'] for result in calcs.set_results]
+        soil_z[(auto, offset)] = results
+        assert len(calcs.disparity_history) == (3 if auto else 0), calcs.disparity_history
+        if auto:
+            assert calculation._search_range(48) == (15, 16), calculation._search_range(48)
+            history = CalculateMultiple(core).disparity_history
+            assert history == calcs.disparity_history, history
+        messages = [log['message'] for log in core.log.sent]
+        fallback = [message for message in messages if 'range edge' in message]
+        assert len(fallback) == (1 if offset == 160 else 0), fallback
+    for full, narrowed in zip(soil_z[(0, 320)], soil_z[(1, 320)]):
+        assert abs(full - narrowed) <= 1, soil_z
+    core = _calculation_core(
+        'search_range', auto_search_range=1, calibration_factor=0.7812,
+        calibration_disparity_offset=320, calibration_maximum=330,
+        search_range_history_file=os.path.join(directory.name, 'history_320.json'))
+    calculation = Calculate(core, _pinhole_sets([0])[0],
+                            CalculateMultiple(core).disparity_history)
+    assert calculation._search_range(48) == (15, 16), calculation._search_range(48)
+    with open(core.settings.settings['search_range_history_file'], 'w') as history_file:
+        history_file.write('[[1.0,')
+    assert CalculateMultiple(core).disparity_history == []
+    directory.cleanup()
+
+
+CONVERGING_FIT = [(160, 200), (320, 150), (480, 102), (640, 52), (800, 2),
+                  (960, -48), (1120, -98), (1280, -148)]
+
+
+def test_fit_converged():
+    'Test CalculateMultiple calibration fit convergence.'
+    print_title('CalculateMultiple fit convergence', char='|')
+    os.environ.clear()
+    core = _calculation_core('converged', fit_convergence_tolerance=1)
+    calcs = CalculateMultiple(core)
+    calcs.set_results = [{}]
+
+    def _add_set(disparity, distance):
+        calcs.set_results.append({'values': {
+            'disparity': disparity,
+            'new_meas_dist': distance,
+            'calc_distance': distance,
+        }})
+    for disparity, distance in CONVERGING_FIT[:2]:
+        _add_set(disparity, distance)
+    assert not calcs.fit_converged()
+    _add_set(*CONVERGING_FIT[2])
+    assert not calcs.fit_converged()
+    _add_set(*CONVERGING_FIT[3])
+    assert not calcs.fit_converged()
+    _add_set(*CONVERGING_FIT[4])
+    assert calcs.fit_converged()
+
+
+def test_early_calibration_stop():
+    'Test MeasureSoilHeight stops capturing sets once the fit converges.'
+    print_title('MeasureSoilHeight early calibration stop', char='|')
+    measure_soil = _mock_measure_soil(
+        frame_discard_count=0, number_of_stereo_sets=8, minimum_stereo_sets=3,
+        early_calibration_stop=1)
+    calcs = CalculateMultiple(measure_soil.core)
+    calcs.set_results = []
+
+    def _calculate_set(i, _title):
+        measure_soil.calculations = calcs
+        disparity, distance = CONVERGING_FIT[i]
+        calcs.set_results.append({'values': {
+            'disparity': disparity,
+            'new_meas_dist': distance,
+            'calc_distance': distance,
+        }})
+    measure_soil._calculate_set = _calculate_set
+    measure_soil.capture_images()
+    measure_soil.shutdown_pipeline()
+    sets = len(measure_soil.images)
+    assert sets == 5, sets
+    z_moves = [coords['z'] for coords in measure_soil.device.position_history]
+    assert z_moves == [0, 0, -50, -50, -100, -100, -150, -150, -200, -200, 0], z_moves
+
+
+def test_luma_only():
+    'Test MeasureSoilHeight luma-only captures.'
+    print_title('MeasureSoilHeight luma only', char='|')
+    measure_soil = _mock_measure_soil(
+        calibration_factor=1, calibration_disparity_offset=160, verbose=3,
+        use_plant_color_mask=0, luma_only=1)
+    measure_soil.capture_images()
+    shapes = [image['data'].shape for image in measure_soil.images[0]['left']]
+    assert shapes == [(100, 100)], shapes
+    measure_soil.calculate()
+    posts = measure_soil.core.results.tools.post_history
+    assert posts == [['points', _point(-100)]], posts
+
+
 def test_measure_soil_height_serial(distance):
     'Test MeasureSoilHeight over serial.'
     print_title('MeasureSoilHeight serial', char='|')
@@ -179,6 +988,33 @@ if __name__ == '__main__':
         test_measure_soil_height_serial(measured_distance)
         sys.exit(0)
     test_calibration()
+    test_calibration(pipelined=True)
+    test_pipeline_remeasure()
+    test_analytical_calibration()
+    test_results_outbox()
     test_measure_soil_height()
+    test_log_batching()
+    test_capture_timing()
+    test_persistent_camera()
+    test_adaptive_frame_discard()
+    test_wait_for_position()
+    test_capture_location()
+    test_firmware_state()
+    test_serial_device()
+    test_serial_queue()
+    test_serial_trace()
+    test_fuse_captures()
+    test_sweep_capture()
+    test_dual_camera()
+    test_capture_quality_check()
+    test_analytical_factor()
+    test_disparity_engines()
+    test_preprocess_cache()
+    test_disparity_workers()
+    test_median_fusion()
+    test_auto_search_range()
+    test_fit_converged()
+    test_early_calibration_stop()
+    test_luma_only()
     failure = test_calculate_multiple()
     sys.exit(bool(failure))
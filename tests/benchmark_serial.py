@@ -0,0 +1,91 @@
+#!/usr/bin/env python3.8
+
+'''Benchmark SerialDevice against simulated firmware.
+
+Usage: python -m tests.benchmark_serial [latency_ms] [jitter_ms] [noise]
+'''
+
+import os
+import sys
+import tempfile
+from time import time
+import numpy as np
+from settings import Settings
+from serial_device import SerialDevice
+from tests.firmware_simulator import FirmwareSimulator
+
+
+def _connect(firmware, cache_file):
+    os.environ.clear()
+    os.environ['measure_soil_height_serial_port'] = firmware.port
+    os.environ['measure_soil_height_serial_param_cache'] = cache_file
+    os.environ['measure_soil_height_log_verbosity'] = '0'
+    start = time()
+    firmware.write('R99 ARDUINO STARTUP COMPLETE')
+    device = SerialDevice(Settings().settings)
+    return device, time() - start
+
+
+def _summary(label, durations):
+    milliseconds = np.array(durations) * 1000
+    print(f'{label:<28}{milliseconds.mean():>8.1f}'
+          f'{np.percentile(milliseconds, 95):>8.1f}{len(milliseconds):>6}')
+
+
+def benchmark(latency=0.005, jitter=0.0, noise=0.0, count=50):
+    'Measure startup, round trip, and movement times.'
+    options = {'latency': latency, 'jitter': jitter, 'noise': noise,
+               'startup_delay': 0, 'report_interval': 0.05}
+    print(f'{"":<28}{"mean ms":>8}{"p95 ms":>8}{"n":>6}')
+    with tempfile.TemporaryDirectory() as directory, \
+            FirmwareSimulator(**options) as firmware:
+        cache_file = os.path.join(directory, 'serial_param_cache.json')
+        for label in ['startup (cold cache)', 'startup (warm cache)']:
+            device, duration = _connect(firmware, cache_file)
+            _summary(label, [duration])
+            device.close()
+        device, _ = _connect(firmware, '')
+
+        durations = []
+        for _ in range(count):
+            start = time()
+            device.send('F21 P71')
+            durations.append(time() - start)
+        _summary('parameter read', durations)
+
+        durations = []
+        for _ in range(count // 4):
+            start = time()
+            requests = [device.send_async(f'F21 P{p}') for p in [71, 72, 73]]
+            for request in requests:
+                device.result(request)
+            durations.append(time() - start)
+        _summary('3 parameter reads in flight', durations)
+
+        durations = []
+        for _ in range(count):
+            start = time()
+            device.get_current_position()
+            durations.append(time() - start)
+        _summary('position query', durations)
+
+        durations = []
+        overheads = []
+        for direction in [1, -1] * (count // 10):
+            args = {'Y': firmware.position['y'] + direction * 10}
+            modeled = firmware.move_duration(args)
+            start = time()
+            device.move_relative(0, direction * 10, 0, 100)
+            durations.append(time() - start)
+            overheads.append(durations[-1] - modeled)
+        _summary('move_relative (10 mm)', durations)
+        _summary('move_relative overhead', overheads)
+        device.close()
+
+
+if __name__ == '__main__':
+    ARGS = [float(arg) for arg in sys.argv[1:]]
+    LATENCY = ARGS[0] / 1000 if len(ARGS) > 0 else 0.005
+    JITTER = ARGS[1] / 1000 if len(ARGS) > 1 else 0
+    NOISE = ARGS[2] if len(ARGS) > 2 else 0
+    benchmark(LATENCY, JITTER, NOISE)
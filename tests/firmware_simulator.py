@@ -0,0 +1,203 @@
+#!/usr/bin/env python3.8
+
+'''Simulated FarmBot firmware on a pseudo-terminal.
+
+Speaks the subset of the F/G/R code protocol used by `SerialDevice`
+(F21, F22, F41, F82, F83, F84, G00) and models movement time from the
+configured axis speeds. Point `measure_soil_height_serial_port` at `port`.
+'''
+
+import os
+import pty
+import tty
+import random
+import select
+import threading
+from time import time, sleep
+
+DEFAULT_PARAMS = {2: 0, 53: 0, 71: 800, 72: 800, 73: 1000}
+STEPS_PER_MM = {'x': 5, 'y': 5, 'z': 25}
+
+
+class FirmwareSimulator():
+    'Respond to G and F codes like the firmware, with modeled timing.'
+
+    def __init__(self, **options):
+        self.options = {
+            'latency': 0.0,  # one-way link delay (s)
+            'jitter': 0.0,  # random extra one-way delay (s)
+            'noise': 0.0,  # chance of an unrelated debug line per response
+            'time_scale': 1.0,  # movement time multiplier
+            'report_interval': 0.1,  # idle and movement report period (s)
+            'startup_delay': 0.2,  # boot time after the port is opened (s)
+            'version': '6.5.0.G',
+        }
+        self.options.update(options)
+        self.params = dict(DEFAULT_PARAMS)
+        self.position = {'x': 0., 'y': 0., 'z': 0.}
+        self.received = []
+        self.outbox = []
+        self.last_due = 0
+        self.condition = threading.Condition()
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        'Start responding to commands.'
+        self.running = True
+        self.threads = [threading.Thread(target=target, daemon=True)
+                        for target in [self._run, self._deliver]]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        'Stop responding and close the pseudo-terminal.'
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_args):
+        self.stop()
+
+    def _delay(self):
+        return self.options['latency'] + random.random() * self.options['jitter']
+
+    def write(self, line):
+        'Queue a line for the host, delivered after the link delay.'
+        with self.condition:
+            if random.random() < self.options['noise']:
+                self._queue('R99 debug message')
+            self._queue(line)
+            self.condition.notify_all()
+
+    def _queue(self, line):
+        # Lines never overtake each other on the link.
+        self.last_due = max(self.last_due, time() + self._delay())
+        self.outbox.append((self.last_due, line))
+
+    def _deliver(self):
+        while self.running:
+            with self.condition:
+                while self.running and not self.outbox:
+                    self.condition.wait(0.1)
+                wait = self.outbox[0][0] - time() if self.outbox else 0
+                if wait > 0:
+                    self.condition.wait(wait)
+                now = time()
+                due = [line for when, line in self.outbox if when <= now]
+                self.outbox = self.outbox[len(due):]
+            if due:
+                data = ''.join(f'{line}\r\n' for line in due)
+                os.write(self.master, bytes(data, 'utf-8'))
+
+    def _run(self):
+        sleep(self.options['startup_delay'])
+        self.write('R99 ARDUINO STARTUP COMPLETE')
+        buffer = b''
+        inbox = []
+        last_report = time()
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.001)
+            if ready:
+                buffer += os.read(self.master, 1024)
+                *lines, buffer = buffer.split(b'\n')
+                arrival = time() + self._delay()
+                inbox += [(arrival, line) for line in lines]
+            while inbox and inbox[0][0] <= time():
+                line = inbox.pop(0)[1].strip().decode()
+                if line:
+                    self.handle(line)
+                    last_report = time()
+            if time() - last_report > self.options['report_interval']:
+                self.report_idle()
+                last_report = time()
+
+    def report_idle(self):
+        'Send periodic status reports.'
+        self.write(f'R82 {self._coordinates()} Q0')
+        self.write('R00 Q0' if self.params[2] else 'R88 Q0')
+
+    def _coordinates(self):
+        return ' '.join(f'{axis.upper()}{value:.2f}'
+                        for axis, value in self.position.items())
+
+    def handle(self, line):
+        'Respond to a received command.'
+        self.received.append(line)
+        words = line.split(' ')
+        args = {word[0]: word[1:] for word in words[1:] if word}
+        tagged = 'Q' in args
+        tag = args.pop('Q', '0')
+        self.write(f'R08 {line}' if tagged else f'R08 {line} Q0')
+        self.write(f'R01 Q{tag}')
+        code = words[0]
+        if code == 'G00':
+            self.move(args)
+            self.write(f'R82 {self._coordinates()} Q{tag}')
+        elif code == 'F82':
+            self.write(f'R82 {self._coordinates()} Q{tag}')
+        elif code == 'F83':
+            self.write(f"R83 {self.options['version']} Q{tag}")
+        elif code == 'F84':
+            for axis in self.position:
+                if args.get(axis.upper()) == '1':
+                    self.position[axis] = 0.
+            self.write(f'R84 {self._coordinates()} Q{tag}')
+        elif code in ['F21', 'F22']:
+            param = int(args['P'])
+            if code == 'F22':
+                self.params[param] = int(float(args['V']))
+            self.write(f'R21 P{param} V{self.params.get(param, 0)} Q{tag}')
+        elif code != 'F41':
+            self.write(f'R03 Q{tag}')
+            return
+        self.write(f'R02 Q{tag}')
+
+    def move_duration(self, args):
+        'Modeled time for a G00 move from the current position.'
+        duration = 0
+        for axis, speed_key, param in zip('xyz', 'ABC', [71, 72, 73]):
+            speed = float(args.get(speed_key, self.params[param]))
+            target = float(args.get(axis.upper(), self.position[axis]))
+            steps = abs(target - self.position[axis]) * STEPS_PER_MM[axis]
+            duration = max(duration, steps / max(speed, 1))
+        return duration * self.options['time_scale']
+
+    def move(self, args):
+        'Move to the requested coordinates, reporting position on the way.'
+        start = dict(self.position)
+        target = {axis: float(args.get(axis.upper(), start[axis]))
+                  for axis in start}
+        duration = self.move_duration(args)
+        began = time()
+        while time() - began < duration:
+            remaining = duration - (time() - began)
+            sleep(min(self.options['report_interval'], remaining))
+            fraction = min(1, (time() - began) / duration)
+            for axis in start:
+                self.position[axis] = (
+                    start[axis] + (target[axis] - start[axis]) * fraction)
+            self.write(f'R82 {self._coordinates()} Q0')
+        self.position = target
+
+
+if __name__ == '__main__':
+    with FirmwareSimulator() as simulator:
+        print(f'Simulated firmware on {simulator.port}. Ctrl-C to exit.')
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
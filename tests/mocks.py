@@ -2,15 +2,62 @@
 
 'Mocks.'
 
+import sys
+import threading
 from copy import copy
+from time import time as wall_time, sleep
 import numpy as np
+from position import wait_for_position
+
+CLOCK_MODULES = ['measure_height', 'camera', 'position', 'log']
+
+
+class VirtualClock():
+    '''Wall time plus skipped sleeps.
+
+    Computation still takes real time, but sleeps in the main thread return
+    immediately and move the clock forward instead. Other threads sleep for
+    real, so their waits overlap the main thread's instead of adding up.
+    '''
+
+    def __init__(self):
+        self.skipped = 0
+        self.patched = []
+
+    def time(self):
+        'Current simulated time.'
+        return wall_time() + self.skipped
+
+    def sleep(self, seconds):
+        'Advance the clock without waiting, from the main thread only.'
+        if threading.current_thread() is not threading.main_thread():
+            sleep(max(0, seconds))
+            return
+        self.skipped += max(0, seconds)
+
+    def __enter__(self):
+        for name in CLOCK_MODULES:
+            module = sys.modules.get(name)
+            for attr in ['time', 'sleep']:
+                if module is not None and hasattr(module, attr):
+                    self.patched.append((module, attr, getattr(module, attr)))
+                    setattr(module, attr, getattr(self, attr))
+        return self
+
+    def __exit__(self, *_args):
+        for module, attr, original in self.patched:
+            setattr(module, attr, original)
+        self.patched = []
 
 
 class MockDevice():
     'Mock device.'
 
-    def __init__(self, stale=False):
+    def __init__(self, stale=False, clock=None, speeds=None, settle_time=0):
         self.stale = stale
+        self.clock = clock
+        self.speeds = speeds or {'x': 100, 'y': 100, 'z': 20}  # mm/s at 100%
+        self.settle_time = settle_time
         self.position_history = [{'x': 0, 'y': 0, 'z': 0}]
         self.log_history = []
         self.pin_history = []
@@ -31,6 +78,11 @@ class MockDevice():
             return copy(self.position_history[0])
         return copy(self.position_history[-1])
 
+    def wait_for_position(self, expected=None, timeout=0.5, interval=0.05):
+        'Wait until the reported position is fresh and stable.'
+        return wait_for_position(
+            self.get_current_position, expected, timeout, interval)
+
     @staticmethod
     def get_bot_state():
         'Get bot state.'
@@ -43,6 +95,11 @@ class MockDevice():
         position['y'] += kwargs['y']
         position['z'] += kwargs['z']
         self.position_history.append(position)
+        if self.clock is not None:
+            scale = kwargs.get('speed', 100) / 100
+            duration = max(abs(kwargs[axis]) / (speed * scale)
+                           for axis, speed in self.speeds.items())
+            self.clock.sleep(duration + self.settle_time)
 
     def write_pin(self, **kwargs):
         'Write pin value.'
@@ -52,8 +109,10 @@ class MockDevice():
 class MockTools():
     'Mock Farmware Tools wrapper.'
 
-    def __init__(self):
+    def __init__(self, latency=0):
+        self.latency = latency
         self.config_history = []
+        self.config_batches = []
         self.post_history = []
         self.patch_history = []
 
@@ -63,45 +122,77 @@ class MockTools():
             @staticmethod
             def post(endpoint, payload):
                 'Post.'
+                sleep(self.latency)
                 self.post_history.append([endpoint, payload])
 
             @staticmethod
             def patch(endpoint, _id, payload):
                 'Patch.'
+                sleep(self.latency)
                 self.patch_history.append([endpoint, payload])
         self.app = MockApp()
 
     def set_config_value(self, _farmware_name, key, value):
         'Set config value.'
+        sleep(self.latency)
         self.config_history.append([key, value])
 
+    def set_config_values(self, _farmware_name, values):
+        'Set config values.'
+        sleep(self.latency)
+        self.config_batches.append(values)
+        self.config_history.extend([key, value] for key, value in values.items())
+
 
 class MockCV():
     'Mock OpenCV.'
 
-    def __init__(self):
+    def __init__(self, clock=None, grab_latency=0, resolution=(100, 100),
+                 dark_after=None, dark_before=0):
         self.CAP_PROP_FRAME_WIDTH = 'width'
         self.CAP_PROP_FRAME_HEIGHT = 'height'
+        self.clock = clock
+        self.grab_latency = grab_latency
+        self.resolution = resolution
+        self.dark_after = dark_after
+        self.dark_before = dark_before
         self.capture_count = 0
         self.parameter_history = {}
+        self.port_history = []
+        self.release_count = 0
+        mock_cv = self
 
         class MockVideoCapture():
             'Mock VideoCapture.'
 
             def __init__(self, port):
                 self.port = port
+                mock_cv.port_history.append(port)
 
             @staticmethod
             def grab():
                 'Get frame.'
                 self.capture_count += 1
+                if self.clock is not None:
+                    self.clock.sleep(self.grab_latency)
                 return True
 
             @staticmethod
             def read():
                 'Get image.'
-                self.capture_count += 1
-                img = np.zeros([100, 100, 3], np.uint8)
+                MockVideoCapture.grab()
+                return MockVideoCapture.retrieve()
+
+            @staticmethod
+            def retrieve():
+                'Decode grabbed image.'
+                width, height = self.resolution
+                img = np.zeros([height, width, 3], np.uint8)
+                if self.capture_count <= self.dark_before:
+                    return True, img
+                if self.dark_after is not None:
+                    if self.capture_count > self.dark_after:
+                        return True, img
                 if self.capture_count % 4 == 0:
                     col = 50
                 elif self.capture_count % 3 == 0:
@@ -110,7 +201,8 @@ class MockCV():
                     col = 40
                 else:
                     col = 50
-                img[:, col:(col + 10)] = 255
+                col, stripe = col * width // 100, 10 * width // 100
+                img[:, col:(col + stripe)] = 255
                 return True, img
 
             @staticmethod
@@ -118,4 +210,9 @@ class MockCV():
                 'Set parameter.'
                 self.parameter_history[key] = value
 
+            @staticmethod
+            def release():
+                'Release device.'
+                self.release_count += 1
+
         self.VideoCapture = MockVideoCapture